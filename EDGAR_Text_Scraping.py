@@ -9,15 +9,39 @@
 """
 
 import os
+import io
 import csv
 import pandas as pd
 import re
 import time
 
+import array
+import asyncio
+import datetime
+import hashlib
+import json
+import mmap
+import multiprocessing
+import queue
+import sqlite3
+import tempfile
+import struct
+import threading
+import zlib
+from html import unescape
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlsplit, parse_qs
+
 import unicodedata
+from functools import cached_property, partial
 
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
+from bs4.builder import HTMLTreeBuilder
+from bs4.dammit import EntitySubstitution, UnicodeDammit
 from lxml import html
 
 #from multiprocessing import Pool, cpu_count
@@ -26,8 +50,22 @@ import urllib3
 #Disable warnings for scraping
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Parquet files for the master index store if pyarrow is installed, pickled DataFrames otherwise
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# File locks to coordinate the rate limiter between processes
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
-HEADER = {'Host': 'www.sec.gov', 'Connection': 'close',
+
+# Connections are kept alive and pooled by EDGARTransport
+HEADER = {
          'Accept': 'application/json, text/javascript, */*; q=0.01', 'X-Requested-With': 'XMLHttpRequest',
          'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.163 Safari/537.36',
          }
@@ -69,57 +107,445 @@ HEADER = {'Host': 'www.sec.gov', 'Connection': 'close',
 #
 #######################################################
 
-def download_masterindex(year, qtr, flag=False):
-    # Download Master.idx from EDGAR
-    # Loop accounts for temporary server/ISP issues
-    # ND-SRAF / McDonald : 201606
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * +
+# Rate limiting
+#
+#   SEC fair access allows at most 10 requests per second per client and answers
+#   with 403/429 (or 503 if the servers are busy) once this is exceeded.
+#   All requests to EDGAR take a token from one token bucket, whose state is kept
+#   in a small file that is locked for each update, so that all threads,
+#   coroutines and worker processes on a machine share the same budget.
+
+class SECRateLimiter:
+    def __init__(self, state_file=None, max_rate=10, min_rate=0.5, burst=None,
+                 decrease_factor=0.5, increase_step=0.5, recover_after=50,
+                 default_block=10):
+        # max_rate/min_rate = bounds of the request rate in requests per second
+        # burst = size of the token bucket, by default one second of requests at max_rate
+        # decrease_factor = rate multiplier after a throttling response
+        # increase_step, recover_after = the rate is increased by increase_step after
+        #     recover_after consecutive healthy responses
+        # default_block = seconds without requests after a throttling response without Retry-After
+        if state_file is None:
+            state_file = os.path.join(tempfile.gettempdir(), 'edgar_rate_limiter.json')
+        self.state_file = state_file
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate)
+        self.burst = float(burst if burst is not None else max_rate)
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step
+        self.recover_after = recover_after
+        self.default_block = default_block
+        self._thread_lock = threading.Lock()
+
+    def _update_state(self, update):
+        # Apply update(state, now) to the shared state under the file lock and return its result
+        with self._thread_lock:
+            with open(self.state_file, 'a+', encoding='utf-8') as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read())
+                    except ValueError:
+                        state = {}
+                    now = time.time()
+                    state.setdefault('rate', self.max_rate)
+                    state.setdefault('tokens', self.burst)
+                    state.setdefault('updated', now)
+                    state.setdefault('blocked_until', 0.0)
+                    state.setdefault('healthy', 0)
+
+                    result = update(state, now)
+
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+                    else:
+                        f.seek(0)
+                        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        return result
+
+    def _take_token(self, state, now):
+        # Returns 0 if a token was taken, otherwise the seconds to wait before the next try
+        if now < state['blocked_until']:
+            return state['blocked_until'] - now
+
+        rate = min(max(state['rate'], self.min_rate), self.max_rate)
+        state['tokens'] = min(self.burst, state['tokens'] + max(0.0, now - state['updated']) * rate)
+        state['updated'] = now
+        if state['tokens'] >= 1:
+            state['tokens'] -= 1
+            return 0
+        return (1 - state['tokens']) / rate
+
+    def acquire(self):
+        # Block until a request may be sent
+        while True:
+            wait = self._update_state(self._take_token)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def report(self, status_code, retry_after=None):
+        # Adjust the rate to the response: tighten on throttling, relax when healthy
+        throttled = status_code in (403, 429, 503)
+        block = parse_retry_after(retry_after)
+
+        def update(state, now):
+            if throttled:
+                state['rate'] = max(self.min_rate, state['rate'] * self.decrease_factor)
+                state['tokens'] = 0.0
+                state['updated'] = now
+                state['blocked_until'] = max(state['blocked_until'],
+                                             now + (block if block is not None else self.default_block))
+                state['healthy'] = 0
+            elif status_code < 400:
+                state['healthy'] += 1
+                if state['healthy'] >= self.recover_after:
+                    state['rate'] = min(self.max_rate, state['rate'] + self.increase_step)
+                    state['healthy'] = 0
+
+        self._update_state(update)
+        return throttled
+
+    def current_rate(self):
+        return self._update_state(lambda state, now: state['rate'])
+
+
+def parse_retry_after(retry_after):
+    # Retry-After header in seconds or as HTTP date, returns seconds or None
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
 
-    from zipfile import ZipFile
-    from io import BytesIO
 
-    number_of_tries = 5
-    sleep_time = 5  # Note sleep time accumulates according to err
+# Shared limiter for all EDGAR requests of this machine
+RATE_LIMITER = SECRateLimiter()
 
+#
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * +
+# HTTP transport
+#
+#   One requests.Session per process keeps the TCP+TLS connections alive and
+#   pools them per host, instead of a new connection for every request.
+#   All requests go through the shared rate limiter and the same retry/backoff policy.
+
+class EDGARTransport:
+    def __init__(self, headers=None, pool_sizes=None, default_pool_size=10,
+                 number_of_tries=3, backoff_factor=2, max_backoff=60,
+                 retry_statuses=(403, 429, 500, 502, 503, 504), rate_limiter=None):
+        # pool_sizes = dict host -> number of pooled connections, e.g. {'www.sec.gov': 10}
+        # number_of_tries, backoff_factor, max_backoff = a failed request is retried up to
+        #     number_of_tries times, sleeping backoff_factor * 2**(try - 1) seconds (at most max_backoff);
+        #     throttling responses wait for the rate limiter instead
+        # retry_statuses = status codes that are retried, all other responses are returned
+        self.headers = HEADER if headers is None else headers
+        self.pool_sizes = dict(pool_sizes or {})
+        self.default_pool_size = default_pool_size
+        self.number_of_tries = number_of_tries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.retry_statuses = set(retry_statuses)
+        self.rate_limiter = RATE_LIMITER if rate_limiter is None else rate_limiter
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+
+    def session(self):
+        # Sessions are not shared with forked worker processes
+        with self._session_lock:
+            if self._session is None or self._session_pid != os.getpid():
+                session = requests.Session()
+                session.headers.update(self.headers)
+                for prefix in ('https://', 'http://'):
+                    session.mount(prefix, HTTPAdapter(pool_maxsize=self.default_pool_size))
+                for host, pool_size in self.pool_sizes.items():
+                    for prefix in ('https://', 'http://'):
+                        session.mount(prefix + host, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+                self._session = session
+                self._session_pid = os.getpid()
+            return self._session
+
+    def set_pool_size(self, host, pool_size):
+        # Change the connection pool size of one host, applied to new sessions
+        with self._session_lock:
+            self.pool_sizes[host] = pool_size
+            self._session = None
+
+    def backoff(self, i):
+        return min(self.max_backoff, self.backoff_factor * 2 ** (i - 1))
+
+    def get(self, url, number_of_tries=None, verbose=True, **kwargs):
+        # GET url with rate limiting and retries, kwargs are passed to requests (e.g. timeout, stream)
+        # Returns the final response, which can have an error status (e.g. 404),
+        # or None if no response was received at all
+        if number_of_tries is None:
+            number_of_tries = self.number_of_tries
+        session = self.session()
+
+        response = None
+        for i in range(1, number_of_tries + 1):
+            try:
+                self.rate_limiter.acquire()
+                response = session.get(url, **kwargs)
+                throttled = self.rate_limiter.report(response.status_code, response.headers.get('Retry-After'))
+
+                if response.status_code not in self.retry_statuses:
+                    return response
+
+                if verbose:
+                    print('  {0}. _url:  {1}'.format(i, url))
+                    print('     Warning: HTTP status {0}'.format(response.status_code))
+                if i < number_of_tries:
+                    response.close()
+                    # The rate limiter already holds back all requests after throttling
+                    if not throttled:
+                        time.sleep(self.backoff(i))
+
+            except requests.RequestException as exc:
+                response = None
+                if verbose:
+                    print('  {0}. _url:  {1}'.format(i, url))
+                    print('     Warning: {0}'.format(str(exc)))
+                if i < number_of_tries:
+                    if verbose:
+                        print('     Retry in {0} seconds'.format(self.backoff(i)))
+                    time.sleep(self.backoff(i))
+
+        return response
+
+    def download(self, url, path, max_size=None, number_of_tries=None, timeout=3,
+                 min_bytes_per_second=100000, grace_period=10, chunk_size=1 << 16, verbose=True):
+        # Stream url in chunks into the file path, resuming with an HTTP Range request
+        # after a dropped connection, so memory use is bounded by chunk_size
+        #   max_size = maximum size in bytes, larger responses are not downloaded
+        #   timeout = connect and read timeout of each request
+        #   min_bytes_per_second, grace_period = a download attempt whose measured throughput is below
+        #             min_bytes_per_second after grace_period seconds is aborted and resumed by the next attempt
+        #   number_of_tries = attempts without progress, each attempt is a single request; an attempt
+        #             that is aborted after receiving content is resumed without using up a try, so a
+        #             large filing on a slow but steady connection is completed in several attempts
+        # Returns (status, response): status is 'OK', 'OVERSIZED' or None if the download failed,
+        # response is the last response (None if no response was received)
+        if number_of_tries is None:
+            number_of_tries = self.number_of_tries
+
+        response = None
+        written = 0
+        i = 0
+        with open(path, 'wb') as f:
+            while i < number_of_tries:
+                i += 1
+                # Ranges refer to the encoded content, so the content is requested uncompressed
+                headers = {'Accept-Encoding': 'identity'}
+                if written:
+                    headers['Range'] = 'bytes={0}-'.format(written)
+                # The attempts of this loop are the retries, get only sends one request
+                response = self.get(url, number_of_tries = 1, verbose = verbose,
+                                    stream = True, timeout = timeout, headers = headers)
+                if response is None or response.status_code in self.retry_statuses:
+                    if i < number_of_tries:
+                        if response is not None:
+                            response.close()
+                        time.sleep(self.backoff(i))
+                    continue
+                if response.status_code/100 >= 3:
+                    return None, response
+                # A server can still compress the response, which is then restarted instead of resumed
+                resumable = response.headers.get('Content-Encoding', 'identity') == 'identity'
+                received = 0
+
+                try:
+                    if response.status_code != 206:
+                        # Full content, e.g. the server ignored the Range header
+                        f.seek(0)
+                        f.truncate()
+                        written = 0
+
+                    # Size of the whole file, unknown for chunked responses
+                    total = None
+                    if response.status_code == 206:
+                        # Content-Range: bytes start-end/total
+                        content_range = re.match(r'bytes (\d+)-\d+/(\d+|\*)', response.headers.get('Content-Range', ''))
+                        if content_range is None or int(content_range.group(1)) != written:
+                            resumable = False
+                            raise requests.ConnectionError('unexpected Content-Range, restart download')
+                        total = int(content_range.group(2)) if content_range.group(2).isdigit() else None
+                    elif response.headers.get('Content-Length', '').isdigit():
+                        total = int(response.headers['Content-Length'])
+
+                    if max_size is not None and total is not None and total > max_size:
+                        response.close()
+                        return 'OVERSIZED', response
+
+
+                    # Throughput of this attempt, a stalled connection raises the read timeout instead
+                    started = time.monotonic()
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+                        written += len(chunk)
+                        received += len(chunk)
+                        if max_size is not None and written > max_size:
+                            response.close()
+                            return 'OVERSIZED', response
+                        elapsed = time.monotonic() - started
+                        if elapsed > grace_period and received / elapsed < min_bytes_per_second:
+                            raise requests.Timeout('download slower than {0} bytes/s'.format(min_bytes_per_second))
+
+                    if not resumable or total is None or written >= total:
+                        return 'OK', response
+                    raise requests.ConnectionError('connection closed after {0} of {1} bytes'.format(written, total))
+
+                except requests.RequestException as exc:
+                    response.close()
+                    if not resumable:
+                        f.seek(0)
+                        f.truncate()
+                        written = 0
+                    if verbose:
+                        print('  {0}. _url:  {1}'.format(i, url))
+                        print('     Warning: {0}'.format(str(exc)))
+                    if resumable and received:
+                        # The next attempt continues where this one stopped
+                        i -= 1
+                        if verbose:
+                            print('     Resume at byte {0}'.format(written))
+                    elif i < number_of_tries:
+                        if verbose:
+                            print('     Resume at byte {0} in {1} seconds'.format(written, self.backoff(i)))
+                        time.sleep(self.backoff(i))
+
+        return None, response
+
+
+# Shared transport for all EDGAR requests of this process
+TRANSPORT = EDGARTransport(pool_sizes={'www.sec.gov': 10})
 
-    PARM_ROOT_PATH = 'https://www.sec.gov/Archives/edgar/full-index/'
+#
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * +
+
+def masterindex_url(year, qtr, root_path=None):
+    # URL of the zipped master.idx of a year/quarter
+    PARM_ROOT_PATH = 'https://www.sec.gov/Archives/edgar/full-index/' if root_path is None else root_path
 
-    masterindex = []
-   
     #  using the zip file is a little more complicated but orders of magnitude faster
     append_path = str(year) + '/QTR' + str(qtr) + '/master.zip'  # /master.idx => nonzip version
-    sec_url = PARM_ROOT_PATH + append_path
+    return PARM_ROOT_PATH + append_path
 
-    for i in range(1, number_of_tries + 1):
-        try:
-            response = requests.get(sec_url, headers=HEADER)
-            if not(response.ok):
-                continue
-            zipfile = ZipFile(BytesIO(response.content))
-            records = zipfile.open('master.idx').read().decode('utf-8', 'ignore').splitlines()[10:]
-            #records = urlopen(sec_url).read().decode('utf-8').splitlines()[10:] #  => nonzip version
+
+def parse_masterindex(content, forms=None, ciks=None, chunksize=100000):
+    # Parse the zipped master.idx content into a DataFrame with MASTERINDEX_COLUMNS
+    # master.idx is streamed from the zip member and parsed in chunks by the C parser of pandas;
+    # each chunk is filtered with hashed form and CIK sets before it is kept, so the cost
+    # does not grow with the number of requested CIKs
+    # The number of valid records before filtering is stored in df.attrs['records']
+    from zipfile import ZipFile
+    from io import BytesIO, TextIOWrapper
+
+    zipfile = ZipFile(BytesIO(content))
+    with zipfile.open('master.idx') as member:
+        return parse_masterindex_stream(TextIOWrapper(member, encoding='utf-8', errors='ignore'),
+                                        forms, ciks, chunksize)
+
+
+def parse_daily_index(content, forms=None, ciks=None, chunksize=100000):
+    # Parse the content of a daily master.YYYYMMDD.idx (same format as master.idx, not zipped)
+    return parse_masterindex_stream(io.TextIOWrapper(io.BytesIO(content), encoding='utf-8', errors='ignore'),
+                                    forms, ciks, chunksize)
+
+
+def parse_masterindex_stream(stream, forms=None, ciks=None, chunksize=100000):
+    # Parse a master index text stream, see parse_masterindex
+    forms = None if forms is None else set(forms)
+    ciks = None if ciks is None else set(int(cik) for cik in ciks)
+
+    # Skip the header, which ends with a line of dashes after the column names
+    for n_line, line in enumerate(stream):
+        if line.startswith('-----') or n_line >= 9:
             break
-        except Exception as exc:
-            if i == 1:
-                print('\nError in download_masterindex')
-            print('  {0}. _url:  {1}'.format(i, sec_url))
 
-            if '404' in str(exc):
-                break
-            if i == number_of_tries:
-                return False
-            time.sleep(sleep_time)
+    frames = []
+    n_records = 0
+    reader = pd.read_csv(stream, sep='|', header=None, names=MASTERINDEX_COLUMNS,
+                         dtype=str, quoting=csv.QUOTE_NONE, keep_default_na=False,
+                         na_values=[''], on_bad_lines='skip', engine='c', chunksize=chunksize)
+    for chunk in reader:
+        # Same validation as MasterIndexRecord: five fields and an integer CIK
+        chunk = chunk.dropna(subset=['cik', 'form', 'filingdate', 'path'])
+        chunk = chunk.assign(cik=pd.to_numeric(chunk['cik'], errors='coerce'),
+                             name=chunk['name'].fillna(''))
+        chunk = chunk[chunk['cik'].notna()]
+        n_records += len(chunk)
+
+        if forms is not None:
+            chunk = chunk[chunk['form'].isin(forms)]
+        if ciks is not None:
+            chunk = chunk[chunk['cik'].isin(ciks)]
+        frames.append(chunk)
+
+    if frames:
+        df = pd.concat(frames, ignore_index=True)
+    else:
+        df = pd.DataFrame(columns = MASTERINDEX_COLUMNS)
+    df['filingdate'] = pd.to_numeric(df['filingdate'].str.replace('-', '', regex=False), errors='coerce')
+    df = df[df['filingdate'].notna()]
+    df = df.astype({'cik': 'int64', 'filingdate': 'int64'}).reset_index(drop=True)
+    df.attrs['records'] = n_records
+    return df
+
+
+def run_parse_masterindex(parse_pool, content, forms=None, ciks=None):
+    # Parse master.idx in the process pool if one is given
+    if parse_pool is None:
+        return parse_masterindex(content, forms, ciks)
+    return parse_pool.submit(parse_masterindex, content, forms, ciks).result()
+
+
+def download_masterindex(year, qtr, flag=False, forms=None, ciks=None, parse_pool=None):
+    # Download Master.idx from EDGAR, optionally keeping only the given forms and CIKs
+    # parse_pool = optional process pool for parsing
+    # Retries for temporary server/ISP issues are handled by the transport
+    # ND-SRAF / McDonald : 201606
+
+    number_of_tries = 5
+    time_out = 60
 
+    sec_url = masterindex_url(year, qtr)
 
+    response = TRANSPORT.get(sec_url, number_of_tries = number_of_tries, timeout = time_out)
+    if response is None or not(response.ok):
+        print('\nError in download_masterindex')
+        print('  _url:  {0}'.format(sec_url))
+        return False
 
-    # Load m.i. records into masterindex list
-    for line in records:
-        mir = MasterIndexRecord(line)
-        if not mir.err:
-            masterindex.append(mir)
+    try:
+        masterindex_df = run_parse_masterindex(parse_pool, response.content, forms, ciks)
+    except Exception as exc:
+        print('\nError in download_masterindex')
+        print('  _url:  {0}'.format(sec_url))
+        print('     Warning: {0}'.format(str(exc)))
+        return False
+    masterindex = frame_to_masterindex(masterindex_df)
 
     if flag:
         print('download_masterindex:  ' + str(year) + ':' + str(qtr) + ' | ' +
-              'len() = {:,}'.format(len(masterindex)))
+              'len() = {:,}'.format(masterindex_df.attrs['records']))
 
     return masterindex
 
@@ -138,208 +564,1233 @@ class MasterIndexRecord:
             self.err = True
         return
 
+    @classmethod
+    def from_values(cls, cik, name, form, filingdate, path):
+        # Record from already parsed values, e.g. a row of the master index store
+        mir = cls.__new__(cls)
+        mir.err = False
+        mir.cik = int(cik)
+        mir.name = name
+        mir.form = form
+        mir.filingdate = int(filingdate)
+        mir.path = path
+        return mir
+
+
+MASTERINDEX_COLUMNS = ['cik', 'name', 'form', 'filingdate', 'path']
+
+
+def frame_to_masterindex(df):
+    # List of master index records from the columnar representation
+    return [MasterIndexRecord.from_values(*row) for row in
+            zip(df['cik'].tolist(), df['name'].tolist(), df['form'].tolist(),
+                df['filingdate'].tolist(), df['path'].tolist())]
+
+#
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *
+# Persistent master index store
+#
+#   Parsed master index records are kept in a local columnar store with one
+#   partition per year/quarter (year=YYYY/qtr=Q/). Closed quarters never change
+#   and are never fetched again, the open quarter is refreshed with a conditional
+#   GET (ETag/Last-Modified) and only downloaded again if EDGAR changed it.
+
+class MasterIndexStore:
+    def __init__(self, store_dir, root_path=None, transport=None, grace_days=1):
+        # store_dir = directory of the store
+        # root_path = full-index root URL, by default EDGAR
+        # grace_days = days after the quarter end until a quarter is considered closed
+        self.store_dir = store_dir
+        self.root_path = root_path
+        self.transport = TRANSPORT if transport is None else transport
+        self.grace_days = grace_days
+        self._frames = {}
+        self._lock = threading.Lock()
+
+    def partition_dir(self, year, qtr):
+        return os.path.join(self.store_dir, 'year={0}'.format(year), 'qtr={0}'.format(qtr))
+
+    def _data_file(self, year, qtr):
+        extension = 'parquet' if pyarrow is not None else 'pkl'
+        return os.path.join(self.partition_dir(year, qtr), 'master.' + extension)
+
+    def _meta_file(self, year, qtr):
+        return os.path.join(self.partition_dir(year, qtr), 'meta.json')
+
+    def quarter_closed(self, year, qtr, today=None):
+        # A quarter is closed once its last day plus the grace period has passed
+        today = datetime.date.today() if today is None else today
+        quarter_end = (datetime.date(year + 1, 1, 1) if qtr == 4
+                       else datetime.date(year, 3 * qtr + 1, 1)) - datetime.timedelta(days=1)
+        return today > quarter_end + datetime.timedelta(days=self.grace_days)
+
+    def read_meta(self, year, qtr):
+        try:
+            with open(self._meta_file(year, qtr), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_partition(self, year, qtr, df, meta):
+        # Write data and meta data to temporary files first so a crash never leaves a broken partition
+        os.makedirs(self.partition_dir(year, qtr), exist_ok=True)
+        data_file = self._data_file(year, qtr)
+        if pyarrow is not None:
+            df.to_parquet(data_file + '.tmp', index=False)
+        else:
+            df.to_pickle(data_file + '.tmp')
+        os.replace(data_file + '.tmp', data_file)
+
+        with open(self._meta_file(year, qtr) + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(self._meta_file(year, qtr) + '.tmp', self._meta_file(year, qtr))
+
+    def _read_partition(self, year, qtr):
+        data_file = self._data_file(year, qtr)
+        if pyarrow is not None:
+            df = pd.read_parquet(data_file)
+        else:
+            df = pd.read_pickle(data_file)
+        df['form'] = df['form'].astype('category')
+        return df
+
+    def get_quarter(self, year, qtr, refresh=True, parse_pool=None):
+        # Returns the master index DataFrame of a year/quarter, or None if it could not be downloaded
+        # parse_pool = optional process pool for parsing
+        key = (year, qtr)
+        meta = self.read_meta(year, qtr)
+
+        if meta is not None and (meta['closed'] or not refresh):
+            with self._lock:
+                if key not in self._frames:
+                    self._frames[key] = self._read_partition(year, qtr)
+                return self._frames[key]
+
+        sec_url = masterindex_url(year, qtr, self.root_path)
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        response = self.transport.get(sec_url, number_of_tries = 5, timeout = 60, headers = headers)
+        if response is None or not (response.ok or response.status_code == 304):
+            print('\nError in MasterIndexStore for _url:  {0}'.format(sec_url))
+            # Fall back to the stored version of an open quarter
+            if meta is not None:
+                return self.get_quarter(year, qtr, refresh=False)
+            return None
+
+        closed = self.quarter_closed(year, qtr)
+        if response.status_code == 304:
+            meta['closed'] = closed
+            meta['checked'] = time.time()
+            with open(self._meta_file(year, qtr), 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            return self.get_quarter(year, qtr, refresh=False)
+
+        try:
+            df = run_parse_masterindex(parse_pool, response.content)
+        except Exception as exc:
+            print('\nError in MasterIndexStore for _url:  {0}'.format(sec_url))
+            print('     Warning: {0}'.format(str(exc)))
+            return None
+
+        meta = {'closed': closed,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'checked': time.time(),
+                'records': len(df)}
+        self._write_partition(year, qtr, df, meta)
+
+        df['form'] = df['form'].astype('category')
+        with self._lock:
+            self._frames[key] = df
+        return df
+
+    def query(self, bgnyear, endyear, bgnqtr=1, endqtr=4, forms=None, ciks=None,
+              date_from=None, date_to=None, refresh=True):
+        # Master index records of the window filtered by form, CIK and filing date (YYYYMMDD)
+        frames = []
+        for year in range(bgnyear, endyear + 1):
+            for qtr in range(bgnqtr, endqtr + 1):
+                df = self.get_quarter(year, qtr, refresh=refresh)
+                if df is None or len(df) == 0:
+                    continue
+                mask = pd.Series(True, index=df.index)
+                if forms is not None:
+                    mask &= df['form'].isin(set(forms))
+                if ciks is not None:
+                    mask &= df['cik'].isin(set(ciks))
+                if date_from is not None:
+                    mask &= df['filingdate'] >= date_from
+                if date_to is not None:
+                    mask &= df['filingdate'] <= date_to
+                frames.append(df[mask])
+
+        if not frames:
+            return pd.DataFrame(columns = MASTERINDEX_COLUMNS)
+        result = pd.concat(frames, ignore_index=True)
+        result['form'] = result['form'].astype('str')
+        return result
+
 #
 # * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *
 
 # Replace unicode characters with their "normal" representations
 # and identify item headers in 10-K forms
-def Text_Normlization(text):
-    text = unicodedata.normalize('NFKC', text)
-
-    text = re.sub(r'\n|\r|\t', ' ', text)
-    # Remove double spacing and backslashes
-    text = re.sub(r'\s+', ' ', text)
+#
+#   All patterns are compiled once at import. The substitutions are applied in the
+#   same order as the original one-pattern-per-step version, and steps are only
+#   merged where the merged pass gives identical output:
+#     - \n, \r and \t are whitespace, so one \s+ pass replaces the two whitespace passes
+#     - ':' and '*' removal and '-' -> ' ' are independent single characters (str.translate)
+#     - ONE/TWO/THREE: a TWO followed by NE loses its O to the earlier ONE pass,
+#       hence the lookahead in the merged pattern
+#     - the '1.', '2.' and '3.' passes can neither create nor overlap each other's matches
+#   The item header passes depend on each other's output and stay sequential,
+#   but are skipped for text without 'ITEM' or 'PART I', which they could not change.
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+ITEM_HEADER_GUARD = re.compile("ITEM|PART I", re.IGNORECASE)
+ITEM_HEADER_SUBSTITUTIONS = [
+    (re.compile("Items", re.IGNORECASE), "Item"),
+    (re.compile("PART I", re.IGNORECASE), ""),
+    (re.compile("ITEM III", re.IGNORECASE), "Item 3"),
+    (re.compile("ITEM II", re.IGNORECASE), "Item 2"),
+    (re.compile("Item I|Item l", re.IGNORECASE), "Item 1"),
+]
+PUNCTUATION_TABLE = str.maketrans({':': None, '*': None, '-': ' '})
+NUMBER_WORD_PATTERN = re.compile("(ONE)|(TWO)(?!NE)|(THREE)", re.IGNORECASE)
+NUMBER_WORD_REPLACEMENT = {1: '1', 2: '2', 3: '3'}
+NUMBER_PERIOD_PATTERN = re.compile(r'([123])\s{0,}\.')
+
+# Separator for batched normalization, neither whitespace nor part of any pattern
+BATCH_SEPARATOR = '\x00'
+BATCH_SEPARATOR_PATTERN = re.compile(' ?\x00 ?')
+
+
+def normalize_text_passes(text):
+    # Substitution passes of Text_Normlization after unicode normalization
+    text = WHITESPACE_PATTERN.sub(' ', text)
     # Remove leading space
     text = text.strip()
 
-    text = re.sub(re.compile("Items", re.IGNORECASE), "Item", text)
-    text = re.sub(re.compile("PART I", re.IGNORECASE), "", text)
-    text = re.sub(re.compile("ITEM III", re.IGNORECASE), "Item 3", text)
-    text = re.sub(re.compile("ITEM II", re.IGNORECASE), "Item 2", text)
-    text = re.sub(re.compile("Item I|Item l", re.IGNORECASE), "Item 1", text)
+    if ITEM_HEADER_GUARD.search(text):
+        for pattern, replacement in ITEM_HEADER_SUBSTITUTIONS:
+            text = pattern.sub(replacement, text)
 
-    text = re.sub(re.compile(":|\\*", re.IGNORECASE), "", text)
-    text = re.sub('-', ' ', text)
+    text = text.translate(PUNCTUATION_TABLE)
+    text = NUMBER_WORD_PATTERN.sub(lambda m: NUMBER_WORD_REPLACEMENT[m.lastindex], text)
+    text = NUMBER_PERIOD_PATTERN.sub(r'\1', text)
+    return text
 
-    text = text.replace("ONE", "1")
-    text = re.sub(re.compile("ONE", re.IGNORECASE), "1", text)
-    text = re.sub(re.compile("TWO", re.IGNORECASE), "2", text)
-    text = re.sub(re.compile("THREE", re.IGNORECASE), "3", text)
 
-    text = re.sub(r'1\s{0,}\.', '1', text)
-    text = re.sub(r'2\s{0,}\.', '2', text)
-    text = re.sub(r'3\s{0,}\.', '3', text)
-    return text
+def Text_Normlization(text):
+    text = unicodedata.normalize('NFKC', text)
+    return normalize_text_passes(text)
+
+
+def Text_Normlization_batch(texts):
+    # Normalize a list of text nodes with one pass of each pattern over all nodes
+    # Same output as list(map(Text_Normlization, texts))
+    texts = list(texts)
+    if not texts:
+        return []
+
+    joined = BATCH_SEPARATOR.join(texts)
+    if joined.count(BATCH_SEPARATOR) != len(texts) - 1:
+        # The separator occurs in the text itself
+        return list(map(Text_Normlization, texts))
+
+    # The separator is a starter without compositions, so NFKC never joins characters across nodes
+    joined = unicodedata.normalize('NFKC', joined)
+    joined = WHITESPACE_PATTERN.sub(' ', joined)
+    # Strip each node
+    joined = BATCH_SEPARATOR_PATTERN.sub(BATCH_SEPARATOR, joined)
+    return normalize_text_passes(joined).split(BATCH_SEPARATOR)
+
+
+ITEM_PREFIX = re.compile("ITEM", re.IGNORECASE)
+
+# Item headers split over two text nodes, e.g. 'Item 1' and 'Business'
+ITEM_NUMBER_LINE = re.compile(r"^ITEM\s{0,}\d{0,}\s{0,}$|^ITEM\s{0,}1 AND 2\s{0,}$", re.IGNORECASE)
+
+# Start and end lines of the business description, the second pair is used if the first start line is not found
+BUSINESS_STARTLINE = re.compile(r"^ITEM\s{0,}1\s{0,}\W{0,}\s{0,}BUSINESS\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}1\s{0,}\W{0,}\s{0,}DESCRIPTION OF BUSINESS\s{0,}\.{0,1}\s{0,}$", re.IGNORECASE)
+BUSINESS_ENDLINE = re.compile(r"^ITEM\s{0,}2\s{0,}\W{0,}\s{0,}PROPERTIES\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}2\s{0,}\W{0,}\s{0,}DESCRIPTION OF PROPERTY\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}2\s{0,}\W{0,}\s{0,}REAL ESTATE\s{0,}\.{0,1}\s{0,}$", re.IGNORECASE)
+BUSINESS_STARTLINE_FALLBACK = re.compile(r"^ITEM\s{0,}1 AND 2\s{0,}\W{0,}\s{1,}BUSINESS AND PROPERTIES\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}1 AND 2\s{0,}\W{0,}\s{1,}BUSINESS AND DESCRIPTION OF PROPERTY\s{0,}\.{0,1}\s{0,}$", re.IGNORECASE)
+BUSINESS_ENDLINE_FALLBACK = re.compile(r"^ITEM\s{0,}3s{0,}\W{0,}\s{1,}LEGAL PROCEEDINGS\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}3s{0,}\W{0,}\s{1,}LEGAL MATTERS\s{0,}\.{0,1}\s{0,}$", re.IGNORECASE)
+
+# Any item header line, e.g. 'Item 7A. Quantitative and Qualitative Disclosures About Market Risk'
+ITEM_HEADING = re.compile(r"^ITEM\s{0,}(\d{1,2})\s{0,}([A-Z])?(?![A-Z0-9])\W{0,}(.*)$", re.IGNORECASE)
+ITEM_HEADING_MAXLEN = 200
+
+# Sections of the item index: name -> (item number, pattern the item title must match or None)
+ITEM_SECTIONS = {
+    '1': ('1', None),
+    '1A': ('1A', None),
+    '7': ('7', None),
+    '7A': ('7A', None),
+    # Part I Item 2 of a 10-Q, Part II Item 2 has the same number but another title
+    '10Q_2': ('2', re.compile("MANAGEMENT", re.IGNORECASE)),
+}
+
+
+class ItemIndex:
+    # Item headers of a normalized text tree, found in one pass over the lines
+    #   lines    = non-empty normalized lines, split item headers concatenated with the following line
+    #   offsets  = character offset of each line in the full text of the filing
+    #   headings = (item, title, first line, start offset) of each item header
+    # Sections are sliced from the full text by offsets, without another pass over the text
+
+    def __init__(self, normalized_tree):
+        self.lines = []
+        self.offsets = []
+        self.headings = []
+        self.startline_positions = []
+        self.endline_positions = []
+        fallback_startline_positions = []
+        fallback_endline_positions = []
+        # Line of the last item header
+        self._heading_line = None
+
+        offset = 0
+        previous = None
+        previous_item = None
+        for node in normalized_tree:
+            # Same as removing the lines matching ^\s*$, nodes are stripped by the normalization
+            collapsed = node.strip()
+            if not collapsed:
+                continue
+            if '  ' in collapsed:
+                # Double spaces left by removing 'PART I'
+                collapsed = WHITESPACE_PATTERN.sub(' ', collapsed)
+
+            m = len(self.lines)
+            self.offsets.append(offset)
+            # Lines are joined by one space in the full text
+            offset += len(collapsed) + 1
+
+            # Concatenate the section headers divisions
+            concatenated = previous_item and ITEM_NUMBER_LINE.match(previous)
+            line = self.lines[-1] + ' ' + node if concatenated else node
+            self.lines.append(line)
+            previous = node
+            previous_item = ITEM_PREFIX.match(node)
+
+            # All header patterns start with 'ITEM'
+            if concatenated or previous_item:
+                if BUSINESS_STARTLINE.match(line):
+                    self.startline_positions.append(m)
+                if BUSINESS_ENDLINE.match(line):
+                    self.endline_positions.append(m)
+                if BUSINESS_STARTLINE_FALLBACK.match(line):
+                    fallback_startline_positions.append(m)
+                if BUSINESS_ENDLINE_FALLBACK.match(line):
+                    fallback_endline_positions.append(m)
+
+            if concatenated or self._heading_line == m - 1 or ITEM_PREFIX.match(node.lstrip()):
+                self._add_heading(m, line, concatenated)
+
+        self.length = max(offset - 1, 0)
+
+        # For the case that we can't find the regular expressions
+        # as we would expect them, there must be some other pattern
+        # of business descriptions
+        if len(self.startline_positions) == 0:
+            self.startline_positions += fallback_startline_positions
+            self.endline_positions += fallback_endline_positions
+
+    def _add_heading(self, m, line, concatenated):
+        first = m
+        if concatenated:
+            # The header line was split, the header starts with the previous line
+            first = m - 1
+            if self._heading_line == m - 1:
+                # Replace the header found in the previous line
+                first = self.headings.pop()[2]
+                self._heading_line = None
+
+        if self._heading_line == m - 1 and not self.headings[-1][1]:
+            # Title of a header like 'Item 1A.' in the following line
+            item, _, heading_line, heading_offset = self.headings[-1]
+            self.headings[-1] = (item, line[:ITEM_HEADING_MAXLEN], heading_line, heading_offset)
+
+        # The normalization can leave a leading space, e.g. after removing 'PART I'
+        line = line.lstrip()
+        heading = ITEM_HEADING.match(line) if len(line) <= ITEM_HEADING_MAXLEN else None
+        if heading:
+            item = heading.group(1) + (heading.group(2) or '').upper()
+            self.headings.append((item, heading.group(3).strip(), first, self.offsets[first]))
+            self._heading_line = m
+
+    def item_spans(self, item):
+        # (start, end) offsets of each passage from a header of item to the next header of another item
+        spans = []
+        for i, (heading_item, title, _, start) in enumerate(self.headings):
+            if heading_item != item:
+                continue
+            end = self.length
+            for next_item, _, _, next_start in self.headings[i+1:]:
+                if next_item != item:
+                    end = next_start - 1
+                    break
+            spans.append((start, end, title))
+        return spans
+
+    @cached_property
+    def sections(self):
+        # Offsets of the longest passage of each section in ITEM_SECTIONS,
+        # the table of contents only has short passages
+        sections = {}
+        for name, (item, title_pattern) in ITEM_SECTIONS.items():
+            spans = [(start, end) for start, end, title in self.item_spans(item)
+                     if title_pattern is None or title_pattern.search(title)]
+            if spans:
+                sections[name] = max(spans, key=lambda span: span[1] - span[0])
+        return sections
+
+    def to_dict(self):
+        return {'headings': [[item, title, start] for item, title, _, start in self.headings],
+                'sections': self.sections}
+
+    def business_description(self):
+        # Return the longest passages that seems like the Business Descrp in a 10-K
+        text = self.lines
+        startline_positions = self.startline_positions
+        endline_positions = self.endline_positions
+
+        if (min(len(startline_positions), len(endline_positions)) > 0):
+            passages = []
+            if (len(startline_positions) == len(endline_positions)):
+                for i in range(0,len(startline_positions)):
+                    passages.append(' '.join(text[startline_positions[i]:endline_positions[i]]))
+            else:
+                # if the phrases don't have the same length, use the last mentioning:
+                passages.append(' '.join(text[startline_positions[-1]:endline_positions[-1]]))
+
+            for m in range(0,len(passages)):
+                passages[m] = re.sub(r'\s{2,}', ' ', passages[m])
+
+            return max(passages, key = len)
+        else:
+            return 'PARSINGERROR'
 
 
-def Extract_Business_Desc(text_tree):
+def Extract_Business_Desc(text_tree, normalized=False):
     # Return the longest passages that seems like the Business Descrp in a 10-K
+    # normalized = True if text_tree is already normalized with Text_Normlization
+
+    if not normalized:
+        text_tree = Text_Normlization_batch(text_tree)
+
+    return ItemIndex(text_tree).business_description()
+
 
-    text = list(map(Text_Normlization, text_tree))
-
-    # Remove empty lines and expand the business descriptions
-    empty_line = re.compile(r"^\s*$", re.IGNORECASE)
-    item_number = re.compile(r"^ITEM\s{0,}\d{0,}\s{0,}$|^ITEM\s{0,}1 AND 2\s{0,}$", re.IGNORECASE)
-    # Remove empty lines
-    empty_lines = []
-    for m in range(0, len(text)):
-        if empty_line.match(text[m]):
-            empty_lines.append(m)
-
-    for m in sorted(empty_lines, reverse=True):
-        del text[m]
-
-    # Concatenate the section headers divisions
-    item_numbers = []
-    for m in range(0, (len(text)-1)):
-        if item_number.match(text[m]):
-            item_numbers.append(m)
-
-    for m in item_numbers:
-        text[m+1] = text[m] + ' ' + text[m+1]
-
-    # iterate through the elements to find the right text section
-    startline = re.compile(r"^ITEM\s{0,}1\s{0,}\W{0,}\s{0,}BUSINESS\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}1\s{0,}\W{0,}\s{0,}DESCRIPTION OF BUSINESS\s{0,}\.{0,1}\s{0,}$", re.IGNORECASE)
-    endline = re.compile(r"^ITEM\s{0,}2\s{0,}\W{0,}\s{0,}PROPERTIES\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}2\s{0,}\W{0,}\s{0,}DESCRIPTION OF PROPERTY\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}2\s{0,}\W{0,}\s{0,}REAL ESTATE\s{0,}\.{0,1}\s{0,}$", re.IGNORECASE)
-    startline_positions = []
-    endline_positions = []
-    for m in range(0, len(text)):
-        if startline.match(text[m]):
-            startline_positions.append(m)
-        if endline.match(text[m]):
-            endline_positions.append(m)
-
-    # For the case that we can't find the regular expressions
-    # as we would expect them, there must be some other pattern
-    # of business descriptions
-    if (len(startline_positions) == 0 & len(endline_positions) == 0):
-        startline = re.compile(r"^ITEM\s{0,}1 AND 2\s{0,}\W{0,}\s{1,}BUSINESS AND PROPERTIES\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}1 AND 2\s{0,}\W{0,}\s{1,}BUSINESS AND DESCRIPTION OF PROPERTY\s{0,}\.{0,1}\s{0,}$", re.IGNORECASE)
-        endline = re.compile(r"^ITEM\s{0,}3s{0,}\W{0,}\s{1,}LEGAL PROCEEDINGS\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}3s{0,}\W{0,}\s{1,}LEGAL MATTERS\s{0,}\.{0,1}\s{0,}$", re.IGNORECASE)
-        for m in range(0, len(text)):
-            if startline.match(text[m]):
-                startline_positions.append(m)
-            if endline.match(text[m]):
-                endline_positions.append(m)
-
-
-    if (min(len(startline_positions), len(endline_positions)) > 0):
-        passages = []
-        if (len(startline_positions) == len(endline_positions)):
-            for i in range(0,len(startline_positions)):
-                passages.append(' '.join(text[startline_positions[i]:endline_positions[i]]))
+def Load_item_section(fname_ft, section, store=None):
+    # Text of a section of ITEM_SECTIONS from a _FullText_ file and its _ItemIndex_ file,
+    # None if the section was not found in the filing
+    # store = ShardedTextStore holding the texts instead of files
+    fname_ix = re.sub(r'_FullText_(\d+)\.txt$', r'_ItemIndex_\1.json', fname_ft)
+    sections = json.loads(read_output(fname_ix, store))['sections']
+    if section not in sections:
+        return None
+
+    start, end = sections[section]
+    return read_output(fname_ft, store)[start:end]
+#
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *
+# Submission documents
+#   The full submission .txt file of a filing wraps every document in
+#   <DOCUMENT> ... </DOCUMENT>, with a header (<TYPE>, <SEQUENCE>, <FILENAME>, ...)
+#   and the content in <TEXT> ... </TEXT>. Exhibits, XBRL and uuencoded graphics
+#   or PDFs are often many times the size of the main document.
+
+UUENCODE_BEGIN = re.compile(rb'^begin [0-7]{3,4} \S')
+
+
+def iter_submission_documents(lines, types=None):
+    # Documents of a full submission as (type, filename, content) tuples, read line by line
+    # lines = iterable of byte lines, e.g. a binary file or io.BytesIO
+    # types = document types to return, e.g. {'10-K'}, None for all documents
+    # Documents of other types are skipped without keeping their lines and
+    # uuencoded blocks in returned documents are dropped without decoding them
+    if types is not None:
+        types = {doc_type.upper() for doc_type in types}
+
+    state = None
+    for line in lines:
+        if state is None:
+            if line.startswith(b'<DOCUMENT>'):
+                state = 'header'
+                doc_type, filename = '', ''
+        elif state == 'skip':
+            if line.startswith(b'</DOCUMENT>'):
+                state = None
+        elif state == 'header':
+            if line.startswith(b'<TYPE>'):
+                doc_type = line[6:].strip().decode('latin-1')
+                if types is not None and doc_type.upper() not in types:
+                    state = 'skip'
+            elif line.startswith(b'<FILENAME>'):
+                filename = line[10:].strip().decode('latin-1')
+            elif line.startswith(b'<TEXT>'):
+                state = 'text'
+                content = []
+            elif line.startswith(b'</DOCUMENT>'):
+                state = None
+        elif state == 'uuencoded':
+            if line.rstrip() == b'end':
+                state = 'text'
+        elif state == 'text':
+            if line.startswith(b'</TEXT>') or line.startswith(b'</DOCUMENT>'):
+                yield doc_type, filename, b''.join(content)
+                state = 'skip'
+            elif line.startswith(b'begin ') and UUENCODE_BEGIN.match(line):
+                state = 'uuencoded'
+            else:
+                content.append(line)
+
+
+def Extract_submission_documents(content, types):
+    # Content of the documents of the given types in a full submission,
+    # the whole content if it has no such document (e.g. a single HTML document)
+    documents = [doc for _, _, doc in iter_submission_documents(io.BytesIO(content), types)]
+    if not documents:
+        return content
+    return b''.join(documents)
+
+#
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *
+# Filing document
+
+class TextTreeParser(HTMLParser):
+    # Tokenizer collecting the text nodes of the first body while the document is parsed
+    # (no tree is built), with the tree rules of BeautifulSoup with html.parser: a text
+    # node ends at every tag, also at an end tag without an open element, an end tag
+    # closes the elements opened after its own, and the text of script, style, form and
+    # noscript tags is dropped
+    skipped_tags = frozenset(('script', 'style', 'form', 'noscript'))
+    # Tags closed right away, tags keeping whitespace-only text and tags whose strings are
+    # not text (rt, rp, template), as in BeautifulSoup's HTML tree builder
+    void_tags = frozenset(HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS)
+    preserve_whitespace_tags = frozenset(HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS)
+    string_container_tags = frozenset(HTMLTreeBuilder.DEFAULT_STRING_CONTAINERS)
+    ascii_spaces = ' \n\t\x0c\r'
+
+    def __init__(self):
+        # Character references are resolved here like BeautifulSoup does
+        super().__init__(convert_charrefs=False)
+        self.text_tree = []
+        self.finished = False
+        self._parts = []
+        self._stack = []
+        self._open = {}
+        self._closed_void = []
+        self._body = None
+        self._skip_depth = 0
+        self._preserve_depth = 0
+        self._container_depth = 0
+
+    def _flush(self, cdata=False):
+        # The parser can split one text node over several data calls
+        if not self._parts:
+            return
+        text = ''.join(self._parts)
+        self._parts = []
+        if self._body is None or self._skip_depth:
+            return
+        # Strings in rt, rp and template tags are not text, CDATA sections are
+        if self._container_depth and not cdata:
+            return
+        if not self._preserve_depth and not text.strip(self.ascii_spaces):
+            text = '\n' if '\n' in text else ' '
+        self.text_tree.append(text)
+
+    def _push(self, tag):
+        self._flush()
+        if tag == 'body' and self._body is None and not self.finished:
+            self._body = len(self._stack)
+        self._stack.append(tag)
+        self._open[tag] = self._open.get(tag, 0) + 1
+        self._count(tag, 1, len(self._stack) - 1)
+
+    def _pop_to(self, tag):
+        self._flush()
+        # End tags without an open element are ignored
+        if not self._open.get(tag):
+            return
+        while True:
+            popped = self._stack.pop()
+            self._open[popped] -= 1
+            self._count(popped, -1, len(self._stack))
+            if len(self._stack) == self._body:
+                self._body = None
+                self.finished = True
+            if popped == tag:
+                return
+
+    def _count(self, tag, step, index):
+        # Only the skipped tags in the body count, not e.g. a form around the body
+        if tag in self.skipped_tags and self._body is not None and index > self._body:
+            self._skip_depth += step
+        if tag in self.preserve_whitespace_tags:
+            self._preserve_depth += step
+        if tag in self.string_container_tags:
+            self._container_depth += step
+
+    def handle_starttag(self, tag, attrs):
+        self._push(tag)
+        if tag in self.void_tags:
+            self._pop_to(tag)
+            self._closed_void.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self._push(tag)
+        self._pop_to(tag)
+
+    def handle_endtag(self, tag):
+        # '</br>' after '<br>' closes nothing
+        if tag in self._closed_void:
+            self._closed_void.remove(tag)
         else:
-            # if the phrases don't have the same length, use the last mentioning:
-            passages.append(' '.join(text[startline_positions[-1]:endline_positions[-1]]))
+            self._pop_to(tag)
 
-        for m in range(0,len(passages)):
-            passages[m] = re.sub(r'\s{2,}', ' ', passages[m])
+    def handle_data(self, data):
+        self._parts.append(data)
+
+    def handle_charref(self, name):
+        self._parts.append(unescape('&#%s;' % name))
+
+    def handle_entityref(self, name):
+        self._parts.append(EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name, '&' + name))
+
+    def handle_comment(self, data):
+        # Comments, declarations and processing instructions end a text node, but are not text
+        self._flush()
+
+    handle_decl = handle_pi = handle_comment
+
+    def unknown_decl(self, data):
+        # A CDATA section is a text node of its own
+        self._flush()
+        if data.upper().startswith('CDATA['):
+            self._parts.append(data[len('CDATA['):])
+            self._flush(cdata=True)
+
+    def close(self):
+        super().close()
+        self._flush()
+        return self.text_tree
+
+
+def decode_content(content):
+    # Decode the content like BeautifulSoup (byte order mark, declared encoding, detection)
+    if isinstance(content, str):
+        return content
+    return UnicodeDammit(content, is_html=True).unicode_markup
+
+
+def Extract_text_tree_stream(content, chunk_size=1 << 20):
+    # Text nodes of the body, fed to the parser in chunks until the first body is closed
+    # (e.g. not the following documents of a full submission)
+    text = decode_content(content)
+    parser = TextTreeParser()
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i:i + chunk_size])
+        if parser.finished:
+            break
+    return parser.close()
+
+
+def Extract_text_tree_bs4(content):
+    # Text nodes of the body with BeautifulSoup, slower but more forgiving
+    soup = BeautifulSoup(content, 'html.parser')
+
+    # Remove HTML tags with get_text
+    body = soup.body
+    for tag in body.select('script'):
+        tag.decompose()
+    for tag in body.select('style'):
+        tag.decompose()
+    for tag in body.select('form'):
+        tag.decompose()
+    for tag in body.select('noscript'):
+        tag.decompose()
+    return [m for m in body.strings]
+
+
+def Extract_text_tree(content, encoding=None):
+    # Text nodes of the filing content without script, style, form and noscript tags
+    try:
+        text_tree = Extract_text_tree_stream(content)
+        if text_tree:
+            return text_tree
+    except Exception as exc:
+        print(exc)
+
+    # If the tokenizer fails or finds no body, use BeautifulSoup
+    try:
+        return Extract_text_tree_bs4(content)
+    except Exception as exc:
+        print(exc)
+        # Last resort for content without body, all text nodes with the lxml tree
+        tree = html.fromstring(content.decode(encoding))
+        text_tree_object =  tree.xpath("//text()[not(ancestor::script)][not(ancestor::style)][not(ancestor::noscript)][not(ancestor::form)]")
+        return [str(x) for x in text_tree_object]
+
+
+class Filing:
+    # Parsed filing that holds the raw text tree once; raw text, normalized text tree,
+    # full text and business description are computed on first access and cached,
+    # so each expensive step runs at most once per filing
+
+    def __init__(self, text_tree):
+        self.text_tree = text_tree
+
+    @classmethod
+    def from_content(cls, content, encoding=None):
+        return cls(Extract_text_tree(content, encoding))
+
+    @cached_property
+    def raw_text(self):
+        return '\n'.join(self.text_tree)
+
+    @cached_property
+    def normalized_tree(self):
+        return Text_Normlization_batch(self.text_tree)
+
+    @cached_property
+    def full_text(self):
+        # \n, \r and \t are whitespace, so one pass removes them together with double spacing
+        full_text = WHITESPACE_PATTERN.sub(' ', ' '.join(self.normalized_tree))
+        return full_text.strip()
+
+    @cached_property
+    def item_index(self):
+        return ItemIndex(self.normalized_tree)
+
+    @cached_property
+    def sections(self):
+        # Text of each section of ITEM_SECTIONS found in the filing
+        return {name: self.full_text[start:end] for name, (start, end) in self.item_index.sections.items()}
+
+    @cached_property
+    def business_description(self):
+        # Business description or 'PARSINGERROR'
+        return self.item_index.business_description()
 
-        return max(passages, key = len)
-    else:
-        return 'PARSINGERROR'
 #
 # * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * *
 
-def Business_description_to_doc(masterindex_item):
-    # Download url content to string text and extract the business section
-    # Loop accounts for temporary server/ISP issues
+def filing_file_name(masterindex_item):
+    # Output file name of a filing, e.g. 20221028_10-K_edgar_data_320193_0000320193-22-000108.txt
+    return (str(masterindex_item.filingdate) + '_' + masterindex_item.form.replace('/', '-') + '_' +
+            masterindex_item.path.replace('/', '_'))
 
-    # Setup EDGAR URL and output file name
-    _url = PARM_EDGARPREFIX + masterindex_item.path
 
-    # Keep track of filings and identify duplicates
-    fid = str(masterindex_item.cik) + str(masterindex_item.filingdate) + masterindex_item.form
+def filing_id(masterindex_item):
+    # Identifier of a filing, same CIK/date/form can appear several times
+    return str(masterindex_item.cik) + str(masterindex_item.filingdate) + masterindex_item.form
+
+
+def count_filing(file_count, masterindex_item):
+    # Keep track of filings and identify duplicates, returns the running count of the filing
+    fid = filing_id(masterindex_item)
     if fid in file_count:
         file_count[fid] += 1
     else:
         file_count[fid] = 1
+    return file_count[fid]
+
+
+def file_hash(path, chunk_size=1 << 20):
+    # sha256 of the content of a file
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FilingDownload:
+    # Filing content downloaded to a temporary file, passed to the parser instead of the content
+    #   status = 'OK', or 'OVERSIZED' if the filing is larger than the maximum size
+    #   encoding = encoding of the response
+    #   sha256 = hash of the content if already known, see content_hash
+
+    def __init__(self, path, status, encoding=None, sha256=None):
+        self.path = path
+        self.status = status
+        self.encoding = encoding
+        self.sha256 = sha256
+
+    def content_hash(self):
+        # sha256 of the downloaded content, computed once
+        if self.sha256 is None:
+            self.sha256 = file_hash(self.path)
+        return self.sha256
+
+    def read(self, document_types=None):
+        # Content of the file, only the documents of document_types if it is a full submission
+        with open(self.path, 'rb') as f:
+            if document_types is not None:
+                documents = [doc for _, _, doc in iter_submission_documents(f, document_types)]
+                if documents:
+                    return b''.join(documents)
+                f.seek(0)
+            return f.read()
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
 
-    fname = (path + str(masterindex_item.filingdate) + '_' + masterindex_item.form.replace('/', '-') + '_' +
-             masterindex_item.path.replace('/', '_'))
-    fname_bd = fname.replace('.txt', '_BusinessDesc' + '_' + str(file_count[fid]) + '.txt')
-    fname_raw = fname.replace('.txt', '_RawText' + '_' + str(file_count[fid]) + '.txt')
-    fname_ft = fname.replace('.txt', '_FullText' + '_' + str(file_count[fid]) + '.txt')
+
+def Download_filing(_url, max_size=None, temp_dir=None):
+    # Download url content into a temporary file in temp_dir (None = system temp directory),
+    # returns a FilingDownload or None if the download failed
+    # Filings larger than max_size bytes are not downloaded and have the status 'OVERSIZED'
+    # Retries for temporary server/ISP issues and resuming are handled by the transport
 
     number_of_tries = 3
-    sleep_time = 5
     time_out = 3
 
-    status = False
+    fd, path = tempfile.mkstemp(suffix='.download', dir=temp_dir)
+    os.close(fd)
+    status, response = TRANSPORT.download(_url, path, max_size = max_size,
+                                          number_of_tries = number_of_tries, timeout = time_out)
+    if status is not None:
+        if status == 'OVERSIZED':
+            os.remove(path)
+        return FilingDownload(path, status, response.encoding)
+    os.remove(path)
+
+    print('\n==>urlopen error in download_to_doc.py')
+    print('  _url:  {0}'.format(_url))
+    if response is not None:
+        print('     Warning: HTTP status {0}'.format(response.status_code))
+    return None
+
+
+class PrimaryDocumentResolver:
+    # Resolves master index entries to the URL of the primary document of the filing
+    # (e.g. the 10-K HTML file) with the filing index page, instead of the full submission .txt
+    #   cache_file = sqlite file caching the resolved documents, None keeps them in memory only
+    #   base_url = EDGAR archive URL, by default PARM_EDGARPREFIX
+    # Filings without a primary document of their form type (e.g. old text filings)
+    # resolve to the full submission
+
+    allowed_suffixes = ('.htm', '.html', '.txt')
+
+    def __init__(self, cache_file=None, base_url=None, transport=None):
+        self.base_url = base_url
+        self.transport = transport
+        self._lock = threading.Lock()
+        # Downloads run in several threads, which share the connection under the lock
+        self._connection = sqlite3.connect(cache_file or ':memory:', check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS primary_document '
+                                     '(path TEXT PRIMARY KEY, document TEXT NOT NULL)')
+
+    def archive_url(self):
+        return self.base_url if self.base_url is not None else PARM_EDGARPREFIX
+
+    def index_url(self, path):
+        # edgar/data/320193/0000320193-22-000108.txt
+        # -> edgar/data/320193/000032019322000108/0000320193-22-000108-index.htm
+        directory, name = path.rsplit('/', 1)
+        accession = name[:-4] if name.endswith('.txt') else name
+        return self.archive_url() + directory + '/' + accession.replace('-', '') + '/' + accession + '-index.htm'
+
+    def cached_document(self, path):
+        with self._lock:
+            row = self._connection.execute('SELECT document FROM primary_document WHERE path = ?',
+                                           (path,)).fetchone()
+        return None if row is None else row[0]
+
+    def _cache_document(self, path, document):
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO primary_document VALUES (?, ?)', (path, document))
+
+    def parse_index(self, content, form, index_url):
+        # URL of the first document of the form type in the 'Document Format Files' table, or None
+        tree = html.fromstring(content)
+        for row in tree.xpath("(//table[@class='tableFile'])[1]//tr[td]"):
+            cells = row.xpath('./td')
+            links = row.xpath('.//a/@href')
+            if len(cells) < 4 or not links:
+                continue
+            if cells[3].text_content().strip().upper() != form.upper():
+                continue
 
-    for i in range(1, number_of_tries + 1):
-        try:
-            response = requests.get(_url, headers=HEADER, timeout = time_out)
-            if response.status_code/100 < 3:
-              status = True
-              break
-        except Exception as exc:
-            if i == 1:
-                print('\n==>urlopen error in download_to_doc.py')
-            print('  {0}. _url:  {1}'.format(i, _url))
-            print('     Warning: {0}'.format(str(exc)))
-            if '404' in str(exc):
-                break
-            print('     Retry in {0} seconds'.format(sleep_time))
-            time.sleep(sleep_time)
+            href = links[0]
+            # Inline XBRL viewer links, e.g. /ix?doc=/Archives/edgar/data/...
+            if '?doc=' in href:
+                href = parse_qs(urlsplit(href).query)['doc'][0]
+            document_url = urljoin(index_url, href)
+            if urlsplit(document_url).path.lower().endswith(self.allowed_suffixes):
+                return document_url
+            return None
+        return None
+
+    def resolve(self, masterindex_item):
+        # URL of the primary document, the full submission if there is none
+        path = masterindex_item.path
+        archive_url = self.archive_url()
+        full_submission = archive_url + path
+
+        document = self.cached_document(path)
+        if document is not None:
+            return urljoin(archive_url, document)
+
+        index_url = self.index_url(path)
+        transport = self.transport or TRANSPORT
+        response = transport.get(index_url, number_of_tries = 3, timeout = 3)
+        if response is None or (response.status_code != 404 and response.status_code/100 >= 3):
+            # Temporary failure, don't cache
+            return full_submission
+
+        document_url = None
+        if response.status_code/100 < 3:
+            document_url = self.parse_index(response.content, masterindex_item.form, index_url)
+        if document_url is None:
+            document_url = full_submission
+
+        # Cache the document relative to the archive, so the base URL can change between runs
+        if document_url.startswith(archive_url):
+            self._cache_document(path, document_url[len(archive_url):])
+        else:
+            self._cache_document(path, document_url)
+        return document_url
 
-    if status:
-        try:
-            soup = BeautifulSoup(response.content, 'html.parser')
-
-            # Remove HTML tags with get_text
-            body = soup.body
-            for tag in body.select('script'):
-                tag.decompose()
-            for tag in body.select('style'):
-                tag.decompose()
-            for tag in body.select('form'):
-                tag.decompose()
-            for tag in body.select('noscript'):
-                tag.decompose()
-            text_tree = [m for m in body.strings]
+    def close(self):
+        with self._lock:
+            self._connection.close()
 
-        except Exception as exc:
-            print(exc)
-            # If html parser fails, use lxml method to parse text (more stable and lenient)
-            tree = html.fromstring(response.content.decode(response.encoding))
-            text_tree_object =  tree.xpath("//text()[not(ancestor::script)][not(ancestor::style)][not(ancestor::noscript)][not(ancestor::form)]")
-            text_tree = [str(x) for x in text_tree_object]
 
+def filing_url(masterindex_item, resolver=None):
+    # URL of the filing, the primary document if a PrimaryDocumentResolver is given
+    if resolver is None:
+        return PARM_EDGARPREFIX + masterindex_item.path
+    return resolver.resolve(masterindex_item)
+
+
+def fetch_filing(masterindex_item, resolver=None, max_size=None, raw_cache=None):
+    # Download a filing (see Download_filing) and keep its content in the raw response cache
+    _url = filing_url(masterindex_item, resolver)
+    download = Download_filing(_url, max_size)
+    if raw_cache is not None and download is not None and download.status == 'OK':
+        raw_cache.put(masterindex_item, _url, download)
+    return download
+
+
+def Business_description_to_doc(masterindex_item, path_dir, count=1, resolver=None, max_size=None):
+    # Download url content to string text and extract the business section
+    # path_dir = output directory, count = running count of the filing (see count_filing)
+    # resolver = PrimaryDocumentResolver to download only the primary document
+    # max_size = maximum filing size in bytes, larger filings are skipped as 'OVERSIZED'
+
+    # Setup EDGAR URL
+    _url = filing_url(masterindex_item, resolver)
+    download = Download_filing(_url, max_size)
+
+    return Parse_filing_to_doc(masterindex_item, count, download, path_dir = path_dir)
+
+
+def Parse_filing_to_doc(masterindex_item, count, content, encoding=None, path_dir=None, split_documents=False,
+                        store=None):
+    # Parse the downloaded filing content (bytes or FilingDownload, None if the download failed),
+    # write the text files and extract the business section
+    # path_dir = output directory, by default the directory of the parsing worker (see init_parse_worker)
+    # split_documents = True parses only the documents of the filing's form type in a full submission
+    # store = ShardedTextStore for the output texts instead of files, by default the store of the parsing worker
+
+    if path_dir is None:
+        path_dir = WORKER_STATE['path']
+        store = WORKER_STATE.get('store')
+
+    # Setup EDGAR URL and output file name
+    _url = PARM_EDGARPREFIX + masterindex_item.path
+
+    fname = path_dir + filing_file_name(masterindex_item)
+    fname_bd = fname.replace('.txt', '_BusinessDesc' + '_' + str(count) + '.txt')
+    fname_raw = fname.replace('.txt', '_RawText' + '_' + str(count) + '.txt')
+    fname_ft = fname.replace('.txt', '_FullText' + '_' + str(count) + '.txt')
+    fname_ix = fname.replace('.txt', '_ItemIndex' + '_' + str(count) + '.json')
+
+    if isinstance(content, FilingDownload):
+        download = content
+        try:
+            if download.status == 'OVERSIZED':
+                print('\n  WARNING:  Filing exceeds the maximum size: {0}'.format(_url))
+                return [masterindex_item.cik, masterindex_item.name, masterindex_item.form,
+                        masterindex_item.filingdate, masterindex_item.path, count, fname, '', '', "OVERSIZED"]
+            if encoding is None:
+                encoding = download.encoding
+            # Read the documents of the submission line by line from the file
+            content = download.read({masterindex_item.form} if split_documents else None)
+            split_documents = False
+        finally:
+            download.remove()
+
+    status = content is not None
+
+    if status:
+        if split_documents:
+            content = Extract_submission_documents(content, {masterindex_item.form})
+        filing = Filing.from_content(content, encoding)
 
         # Write raw text result into output file
-        with open(fname_raw, "w", encoding="utf-8") as f:
-            f.write('\n'.join(text_tree))
-        f.close()
+        write_output(fname_raw, filing.raw_text, store)
 
         # Write full text result into output file
-        full_text = list(map(Text_Normlization, text_tree))
-        full_text = re.sub(r'\n|\r|\t', ' ', ' '.join(full_text))
-        full_text = re.sub(r'\s+', ' ', full_text)
-        full_text = full_text.strip()
+        full_text = filing.full_text
+        write_output(fname_ft, full_text, store)
 
-        with open(fname_ft, "w", encoding="utf-8") as f:
-            f.write(full_text)
-        f.close()
+        # Write the item header offsets into the full text
+        write_output(fname_ix, json.dumps(filing.item_index.to_dict()), store)
 
-        business_descr = Extract_Business_Desc(text_tree)
+        business_descr = filing.business_description
         if not business_descr == 'PARSINGERROR':
 
             # Write actual result into output file
-            with open(fname_bd, "w", encoding="utf-8") as f:
-                f.write(business_descr)
-            f.close()
+            write_output(fname_bd, business_descr, store)
 
             return [masterindex_item.cik, masterindex_item.name, masterindex_item.form,
-                    masterindex_item.filingdate, masterindex_item.path, file_count[fid], fname, full_text, business_descr, True]
+                    masterindex_item.filingdate, masterindex_item.path, count, fname, full_text, business_descr, True]
         else:
             # if itteration is unsuccessful, return buffer text
             return  [masterindex_item.cik, masterindex_item.name, masterindex_item.form,
-                     masterindex_item.filingdate, masterindex_item.path, file_count[fid], fname, full_text, '', "PARSINGERROR"]
+                     masterindex_item.filingdate, masterindex_item.path, count, fname, full_text, '', "PARSINGERROR"]
 
 
     print('\n  ERROR:  Download failed for url: {0}'.format(_url))
     return [masterindex_item.cik, masterindex_item.name, masterindex_item.form,
-            masterindex_item.filingdate, masterindex_item.path, file_count[fid], fname, '', '', "DOWNLOADINGERROR"]
+            masterindex_item.filingdate, masterindex_item.path, count, fname, '', '', "DOWNLOADINGERROR"]
+
+#
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * +
+# Concurrent download and parsing pipeline
+#
+#   Downloaders (coroutines running the blocking requests in a thread pool) push the
+#   raw filing bytes into a bounded queue. Parsers take them from the queue and run
+#   Parse_filing_to_doc in a process pool, so the CPU-heavy parsing overlaps with the
+#   network I/O. The bounded queue stops the downloaders when the parsers fall behind.
+
+# Per-process state of the parsing workers, set by init_parse_worker
+WORKER_STATE = {}
+
+
+def process_pool(max_workers, initializer=None, initargs=()):
+    # Process pool whose workers start in a new interpreter: the pools are fed from several threads,
+    # and a forked worker inherits the locks other threads hold at that moment (e.g. the lock of a
+    # ShardedTextStore in the manifest lookup), so its first use of such a lock would hang
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=initializer, initargs=initargs)
+
+
+class ContentDedup:
+    # Filings with identical downloaded content (e.g. the same document listed under several
+    # CIKs or forms) are parsed and stored once, the duplicates reuse the result of the first one
+    #   originals = raw content hash -> manifest row of the filing scraped in an earlier run
+    #               (see ScrapeManifest.raw_originals)
+    #   raw_hashes = position in scrape_items -> raw content hash of the filing, filled while downloading
+
+    def __init__(self, originals=None):
+        self.originals = originals if originals is not None else {}
+        self.raw_hashes = {}
+        # raw content hash -> future of the result of the first filing of this run
+        self.pending = {}
+
+
+def duplicate_result(masterindex_item, count, path_dir, full_text, business_desc, status):
+    # Result row of a filing with the texts and status of an identical filing
+    return [masterindex_item.cik, masterindex_item.name, masterindex_item.form,
+            masterindex_item.filingdate, masterindex_item.path, count, path_dir + filing_file_name(masterindex_item),
+            full_text, business_desc, status]
+
+
+def original_texts(original, path_dir, store=None):
+    # Full text, business description and status of a filing scraped in an earlier run
+    texts = [read_output(path_dir + original[column], store) if original[column] else ''
+             for column in ('full_text_file', 'business_desc_file')]
+    return texts + [True if original['status'] == 'True' else original['status']]
+
+
+def init_parse_worker(path_dir, store=None):
+    # Initializer of the parsing processes
+    WORKER_STATE['path'] = path_dir
+    WORKER_STATE['store'] = store
+
+
+async def Async_iterate_download_to_doc(scrape_items, path_dir, concurrency=4, parse_processes=None, queue_size=None,
+                                        split_documents=False, resolver=None, max_size=None, store=None,
+                                        raw_cache=None, reparse=False, dedup=None):
+    # Download the filings concurrently and parse them in a process pool
+    # scrape_items is a list of (masterindex_item, count) tuples, yields (position, result) tuples
+    # as the filings are parsed, position is the index of the filing in scrape_items
+    # concurrency = number of requests in flight
+    # parse_processes = number of parsing processes, by default the number of CPUs;
+    #                   0 parses in the download threads instead
+    # queue_size = maximum number of downloaded filings waiting for a parser
+    # split_documents = parse only the main documents of the submissions (see Parse_filing_to_doc)
+    # resolver = PrimaryDocumentResolver to download only the primary documents of the filings
+    # max_size = maximum filing size in bytes, larger filings are skipped as 'OVERSIZED'
+    # store = ShardedTextStore for the output texts instead of files
+    # raw_cache = RawResponseCache keeping the downloaded content
+    # reparse = True reads the filings from raw_cache instead of downloading them
+    # dedup = ContentDedup, filings with the content of an earlier filing are not parsed again
+    # Filings are downloaded into temporary files, which the parsers read and remove
+
+    concurrency = max(1, int(concurrency))
+    if parse_processes is None:
+        parse_processes = os.cpu_count() or 1
+    n_parsers = max(1, parse_processes)
+    if queue_size is None:
+        queue_size = 2 * n_parsers
+
+    if not scrape_items:
+        return
+
+    download_queue = asyncio.Queue()
+    for position, scrape_item in enumerate(scrape_items):
+        download_queue.put_nowait((position, scrape_item))
+    parse_queue = asyncio.Queue(maxsize=queue_size)
+    result_queue = asyncio.Queue()
+
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency + (0 if parse_processes > 0 else n_parsers))
+    if parse_processes > 0:
+        parse_pool = process_pool(parse_processes, init_parse_worker, (path_dir, store))
+    else:
+        parse_pool = executor
+
+    async def downloader():
+        while True:
+            try:
+                position, (masterindex_item, count) = download_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if reparse:
+                download = await loop.run_in_executor(executor, raw_cache.load, masterindex_item)
+            else:
+                download = await loop.run_in_executor(executor, fetch_filing, masterindex_item,
+                                                      resolver, max_size, raw_cache)
+
+            raw_hash = None
+            if dedup is not None and download is not None and download.status == 'OK':
+                raw_hash = await loop.run_in_executor(executor, download.content_hash)
+                dedup.raw_hashes[position] = raw_hash
+                if raw_hash in dedup.originals:
+                    # Same content as a filing of an earlier run, its output files are read instead
+                    download.remove()
+                    texts = await loop.run_in_executor(executor, original_texts, dedup.originals[raw_hash],
+                                                       path_dir, store)
+                    await result_queue.put((position, duplicate_result(masterindex_item, count, path_dir, *texts)))
+                    continue
+                if raw_hash in dedup.pending:
+                    # Same content as a filing of this run, its result is reused once that filing is parsed;
+                    # duplicates never wait in the parse queue, so they cannot hold up the parsers
+                    download.remove()
+                    dedup.pending[raw_hash].add_done_callback(partial(put_duplicate, position, masterindex_item, count))
+                    continue
+                dedup.pending[raw_hash] = loop.create_future()
+            await parse_queue.put((position, masterindex_item, count, download, raw_hash))
+
+    def put_duplicate(position, masterindex_item, count, original):
+        if not original.cancelled():
+            result_queue.put_nowait((position, duplicate_result(masterindex_item, count, path_dir,
+                                                                *original.result()[7:])))
+
+    async def parser():
+        while True:
+            job = await parse_queue.get()
+            if job is None:
+                return
+            position, masterindex_item, count, download, raw_hash = job
+
+            # Parsing processes write to the output directory of their worker state
+            result = await loop.run_in_executor(parse_pool, Parse_filing_to_doc,
+                                                masterindex_item, count, download, None,
+                                                None if parse_processes > 0 else path_dir,
+                                                split_documents, store)
+            await result_queue.put((position, result))
+            if raw_hash is not None:
+                dedup.pending[raw_hash].set_result(result)
+
+    async def run_workers():
+        await asyncio.gather(*[downloader() for _ in range(min(concurrency, len(scrape_items)))])
+        for _ in parsers:
+            await parse_queue.put(None)
+        await asyncio.gather(*parsers)
+
+    parsers = [asyncio.ensure_future(parser()) for _ in range(n_parsers)]
+    workers = asyncio.ensure_future(run_workers())
+    try:
+        for _ in range(len(scrape_items)):
+            # Results are yielded as they arrive, a failed worker ends the iteration with its exception
+            get_result = asyncio.ensure_future(result_queue.get())
+            await asyncio.wait([get_result, workers], return_when=asyncio.FIRST_COMPLETED)
+            if not get_result.done() and workers.exception() is not None:
+                get_result.cancel()
+                workers.result()
+            yield await get_result
+    finally:
+        workers.cancel()
+        for task in parsers:
+            task.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+        if parse_pool is not executor:
+            parse_pool.shutdown(wait=False, cancel_futures=True)
+
+
+def iterate_async(async_iterator, max_pending=16):
+    # Iterate an async iterator from synchronous code, its event loop runs in a background thread
+    # max_pending = maximum number of items waiting for the caller
+    items = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        # Give up if the caller stopped iterating
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    async def consume():
+        loop = asyncio.get_running_loop()
+        try:
+            async for item in async_iterator:
+                if not await loop.run_in_executor(None, put, (item, None)):
+                    break
+        except BaseException as exc:
+            await loop.run_in_executor(None, put, (end, exc))
+            return
+        finally:
+            await async_iterator.aclose()
+        await loop.run_in_executor(None, put, (end, None))
+
+    thread = threading.Thread(target=asyncio.run, args=(consume(),), daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, exc = items.get()
+            if item is end:
+                if exc is not None:
+                    raise exc
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
 
 #
 # * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * +
@@ -349,19 +1800,51 @@ def Business_description_to_doc(masterindex_item):
 def Masterindex_iteratable_download(PARM_LOGFILE, 
                                     PARM_BGNYEAR, PARM_ENDYEAR, 
                                     PARM_BGNQTR, PARM_ENDQTR, 
-                                    PARM_FORMS, PARM_CIK):
+                                    PARM_FORMS, PARM_CIK, store=None,
+                                    PARM_CONCURRENCY=1, quarters=None):
     # Download each year/quarter master.idx and save record for requested forms
+    # quarters = list of (year, qtr) to download instead of the year and quarter window
+    # If a MasterIndexStore is given, the quarters are read from the local store
+    # With PARM_CONCURRENCY > 1 the quarters are fetched concurrently (under the shared rate limit)
+    # and parsed in a process pool while other quarters are still downloading;
+    # the results and log lines keep the year/quarter order
     f_log = open(PARM_LOGFILE, 'w')
     n_qtr = 0
 
+    def fetch_quarter(year, qtr, parse_pool=None):
+        # Filtered master index records of the quarter, False if the download failed
+        if store is None:
+            return download_masterindex(year, qtr, True, PARM_FORMS, PARM_CIK, parse_pool)
+
+        masterindex_df = store.get_quarter(year, qtr, parse_pool=parse_pool)
+        if masterindex_df is None or len(masterindex_df) == 0:
+            return False
+        print('MasterIndexStore:  ' + str(year) + ':' + str(qtr) + ' | ' +
+              'len() = {:,}'.format(len(masterindex_df)))
+        masterindex_df = masterindex_df[masterindex_df['form'].isin(set(PARM_FORMS)) &
+                                        masterindex_df['cik'].isin(set(int(cik) for cik in PARM_CIK))]
+        return frame_to_masterindex(masterindex_df)
+
+    if quarters is None:
+        quarters = [(year, qtr) for year in range(PARM_BGNYEAR, PARM_ENDYEAR + 1)
+                    for qtr in range(PARM_BGNQTR, PARM_ENDQTR + 1)]
+
+    if PARM_CONCURRENCY > 1 and len(quarters) > 1:
+        n_workers = min(PARM_CONCURRENCY, len(quarters))
+        executor = ThreadPoolExecutor(max_workers=n_workers)
+        parse_pool = process_pool(min(n_workers, os.cpu_count() or 1))
+        futures = [executor.submit(fetch_quarter, year, qtr, parse_pool) for year, qtr in quarters]
+        quarter_results = (future.result() for future in futures)
+    else:
+        executor = parse_pool = None
+        quarter_results = (fetch_quarter(year, qtr) for year, qtr in quarters)
+
     masterindex = []
-    for year in range(PARM_BGNYEAR, PARM_ENDYEAR + 1):
-        for qtr in range(PARM_BGNQTR, PARM_ENDQTR + 1):
+    try:
+        for (year, qtr), masterindex_expand in zip(quarters, quarter_results):
 
-            masterindex_expand = download_masterindex(year, qtr, True)
-            if masterindex_expand:
-                masterindex_expand_filtered = list(filter(lambda x: x.form in PARM_FORMS and x.cik in PARM_CIK, masterindex_expand))
-                masterindex.extend(masterindex_expand_filtered)
+            if masterindex_expand is not False:
+                masterindex.extend(masterindex_expand)
                 n_qtr += 1
 
             # time.sleep(1)  # Space out requests
@@ -370,31 +1853,1262 @@ def Masterindex_iteratable_download(PARM_LOGFILE,
             f_log.write('{0} | {1} | n_qtr = {2:>8,}\n'.
                         format(year, qtr, n_qtr))
             f_log.flush()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+            parse_pool.shutdown()
 
     print('{0:,} total forms downloaded.'.format(n_qtr))
     f_log.write('\n{0:,} total forms downloaded.'.format(n_qtr))
 
     return(masterindex)
+
+
+def quarter_bounds(quarters):
+    # First and last filing date YYYYMMDD of a list of (year, qtr)
+    first_year, first_qtr = min(quarters)
+    last_year, last_qtr = max(quarters)
+    return first_year * 10000 + (3 * first_qtr - 2) * 100 + 1, last_year * 10000 + 3 * last_qtr * 100 + 31
+
 #
 # * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * +
+# Query planner
+#   A master index scan downloads every quarter of the window (megabytes each), however few CIKs
+#   are requested. The submissions JSON of data.sec.gov is one small document per CIK, plus older
+#   parts for windows before its recent filings. The planner estimates the bytes of both strategies
+#   and uses the cheaper one; both return lists of MasterIndexRecord.
+
+# Cost model in bytes transferred, each request also takes a slot of the rate limit (REQUEST_COST_BYTES)
+MASTERINDEX_QUARTER_BYTES = 8 * 2 ** 20
+SUBMISSIONS_BYTES = 300 * 2 ** 10
+REQUEST_COST_BYTES = 100 * 2 ** 10
+# The recent filings of a submissions JSON cover at least the last year
+SUBMISSIONS_RECENT_DAYS = 365
+QUERY_STRATEGIES = ('auto', 'submissions', 'masterindex')
+
+
+def submissions_url(name, root_path=None):
+    # URL of a submissions JSON, name is a CIK or the file name of an older part
+    PARM_ROOT_PATH = PARM_SUBMISSIONS_PREFIX if root_path is None else root_path
+    if not str(name).endswith('.json'):
+        name = 'CIK{0:010d}.json'.format(int(name))
+    return PARM_ROOT_PATH + name
+
+
+class SubmissionsSource:
+    # Filings of a CIK from its submissions JSON
+    #   root = submissions root URL, by default PARM_SUBMISSIONS_PREFIX
+
+    def __init__(self, root=None, transport=None):
+        self.root = root
+        self.transport = transport
+
+    def fetch(self, name):
+        # Parsed JSON, {} if it does not exist (unknown CIK), None if the download failed
+        url = submissions_url(name, self.root)
+        transport = TRANSPORT if self.transport is None else self.transport
+        response = transport.get(url, number_of_tries = 3, timeout = 30)
+        if response is not None and response.status_code == 404:
+            return {}
+        if response is None or not response.ok:
+            print('\nError in SubmissionsSource for _url:  {0}'.format(url))
+            return None
+        try:
+            return response.json()
+        except ValueError:
+            print('\nError in SubmissionsSource for _url:  {0}'.format(url))
+            return None
+
+    def records(self, cik, forms=None, quarters=None):
+        # Master index records of the CIK's filings of the forms in the quarters,
+        # None if a JSON could not be downloaded
+        submissions = self.fetch(cik)
+        if submissions is None:
+            return None
+        if not submissions:
+            return []
+        first, last = quarter_bounds(quarters) if quarters else (0, 99999999)
+
+        parts = [submissions['filings']['recent']]
+        for older in submissions['filings'].get('files', []):
+            # Older parts are only needed if they overlap the window
+            if (int(older['filingTo'].replace('-', '')) >= first and
+                    int(older['filingFrom'].replace('-', '')) <= last):
+                part = self.fetch(older['name'])
+                if part is None:
+                    return None
+                parts.append(part)
+
+        forms = None if forms is None else set(forms)
+        quarters = None if quarters is None else set(quarters)
+        name = submissions.get('name', '')
+        records = []
+        for part in parts:
+            for accession, form, filingdate in zip(part['accessionNumber'], part['form'], part['filingDate']):
+                filingdate = int(filingdate.replace('-', ''))
+                if forms is not None and form not in forms:
+                    continue
+                if quarters is not None and quarter_of(filingdate) not in quarters:
+                    continue
+                # Same path as in master.idx, the full submission in the CIK's directory
+                records.append(MasterIndexRecord.from_values(int(cik), name, form, filingdate,
+                                                             'edgar/data/{0}/{1}.txt'.format(int(cik), accession)))
+        return records
+
+
+def submissions_masterindex(forms, ciks, quarters, source=None, concurrency=1):
+    # Master index records of the CIKs from their submissions JSON, per quarter sorted like master.idx;
+    # None if a JSON could not be downloaded
+    source = SubmissionsSource() if source is None else source
+    ciks = sorted(set(int(cik) for cik in ciks))
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        cik_records = list(executor.map(lambda cik: source.records(cik, forms, quarters), ciks))
+    if any(records is None for records in cik_records):
+        return None
+    records = [record for records in cik_records for record in records]
+    records.sort(key=lambda r: (quarter_of(r.filingdate), r.cik, r.name, r.form, r.filingdate, r.path))
+    return records
+
+
+def plan_masterindex_query(quarters, ciks, store=None, today=None):
+    # Strategy ('submissions' or 'masterindex') with the estimated bytes of the submissions JSON
+    # and of the master index scan; closed quarters in the MasterIndexStore cost nothing
+    masterindex_cost = 0
+    for year, qtr in quarters:
+        meta = store.read_meta(year, qtr) if store is not None else None
+        if meta is None or not meta['closed']:
+            masterindex_cost += MASTERINDEX_QUARTER_BYTES + REQUEST_COST_BYTES
+
+    # Windows before the recent filings need an older part of the JSON as well
+    today = datetime.date.today() if today is None else today
+    recent_from = int((today - datetime.timedelta(days=SUBMISSIONS_RECENT_DAYS)).strftime('%Y%m%d'))
+    parts = 2 if quarter_bounds(quarters)[0] < recent_from else 1
+    submissions_cost = len(set(ciks)) * parts * (SUBMISSIONS_BYTES + REQUEST_COST_BYTES)
+
+    strategy = 'submissions' if submissions_cost < masterindex_cost else 'masterindex'
+    return strategy, submissions_cost, masterindex_cost
+
+
+def Masterindex_query(PARM_LOGFILE,
+                      PARM_BGNYEAR, PARM_ENDYEAR,
+                      PARM_BGNQTR, PARM_ENDQTR,
+                      PARM_FORMS, PARM_CIK, store=None,
+                      PARM_CONCURRENCY=1, quarters=None, strategy='auto', source=None):
+    # Master index records for PARM_FORMS and PARM_CIK of the window (or quarters), from the
+    # submissions JSON of the CIKs or from the master index, see Masterindex_iteratable_download
+    # strategy = 'auto' (cheaper of both, see plan_masterindex_query), 'submissions' or 'masterindex'
+    # source = SubmissionsSource, by default from PARM_SUBMISSIONS_PREFIX
+    # If a submissions JSON cannot be downloaded the master index is scanned instead
+    if strategy not in QUERY_STRATEGIES:
+        raise ValueError('strategy must be one of {0}'.format(', '.join(QUERY_STRATEGIES)))
+    if quarters is None:
+        quarters = [(year, qtr) for year in range(PARM_BGNYEAR, PARM_ENDYEAR + 1)
+                    for qtr in range(PARM_BGNQTR, PARM_ENDQTR + 1)]
+    if not quarters:
+        return []
+
+    if strategy == 'auto':
+        strategy, submissions_cost, masterindex_cost = plan_masterindex_query(quarters, PARM_CIK, store)
+        print('Query plan: {0} (submissions JSON ~{1:,.1f} MB, master index ~{2:,.1f} MB)'.format(
+            strategy, submissions_cost / 2 ** 20, masterindex_cost / 2 ** 20))
+
+    if strategy == 'submissions':
+        masterindex = submissions_masterindex(PARM_FORMS, PARM_CIK, quarters, source, PARM_CONCURRENCY)
+        if masterindex is not None:
+            with open(PARM_LOGFILE, 'w') as f_log:
+                f_log.write('Submissions JSON | {0:,} CIKs | {1:,} records\n'.format(len(set(PARM_CIK)), len(masterindex)))
+            print('{0:,} records from the submissions JSON of {1:,} CIKs.'.format(len(masterindex), len(set(PARM_CIK))))
+            return masterindex
+        print('Submissions JSON not available => scan the master index')
+
+    return Masterindex_iteratable_download(PARM_LOGFILE, PARM_BGNYEAR,
+                                           PARM_ENDYEAR, PARM_BGNQTR,
+                                           PARM_ENDQTR, PARM_FORMS,
+                                           PARM_CIK, store,
+                                           PARM_CONCURRENCY, quarters)
+
+
+def open_masterindex_store(PARM_MASTERINDEX_STORE):
+    # Master index store from a directory name, None if no store should be used
+    if PARM_MASTERINDEX_STORE is None or isinstance(PARM_MASTERINDEX_STORE, MasterIndexStore):
+        return PARM_MASTERINDEX_STORE
+    return MasterIndexStore(PARM_MASTERINDEX_STORE)
+
+
+def open_primary_document_resolver(PARM_PRIMARY_DOCUMENT_CACHE):
+    # Primary document resolver from a cache file name, None if full submissions should be downloaded
+    if PARM_PRIMARY_DOCUMENT_CACHE is None or isinstance(PARM_PRIMARY_DOCUMENT_CACHE, PrimaryDocumentResolver):
+        return PARM_PRIMARY_DOCUMENT_CACHE
+    return PrimaryDocumentResolver(PARM_PRIMARY_DOCUMENT_CACHE)
+#
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * +
+# Raw response cache
+#   The downloaded bytes of each filing are kept content addressed, so the filings
+#   can be parsed again (reparse mode) without downloading them from EDGAR:
+#       cache_dir/objects/ab/ab12...ef.z   zlib compressed content, named by its sha256
+#       cache_dir/responses.sqlite          master index entry -> url, sha256, encoding, size
+#   A path can be listed several times in the master index (several filers or forms), so the
+#   entries are keyed like the master index lines.
+
+class RawResponseCache:
+    def __init__(self, cache_dir, compresslevel=6, chunk_size=1 << 20):
+        self.cache_dir = cache_dir
+        self.compresslevel = compresslevel
+        self.chunk_size = chunk_size
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        self._lock = threading.Lock()
+        # Downloads run in several threads, which share the connection under the lock
+        self._connection = sqlite3.connect(os.path.join(cache_dir, 'responses.sqlite'), check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS response ('
+                'cik INTEGER, name TEXT, form TEXT, filingdate INTEGER, path TEXT, '
+                'url TEXT, sha256 TEXT NOT NULL, encoding TEXT, size INTEGER, fetched TEXT, '
+                'PRIMARY KEY (cik, form, filingdate, path))')
+
+    def object_path(self, sha256):
+        return os.path.join(self.cache_dir, 'objects', sha256[:2], sha256 + '.z')
+
+    def put(self, masterindex_item, url, download):
+        # Add the content of a FilingDownload, identical content is stored once
+        sha256 = download.content_hash()
+        size = os.path.getsize(download.path)
+
+        object_path = self.object_path(sha256)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(object_path), suffix='.tmp')
+            compressor = zlib.compressobj(self.compresslevel)
+            with os.fdopen(fd, 'wb') as out, open(download.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                    out.write(compressor.compress(chunk))
+                out.write(compressor.flush())
+            os.replace(tmp_path, object_path)
+
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                     (int(masterindex_item.cik), masterindex_item.name, masterindex_item.form,
+                                      int(masterindex_item.filingdate), masterindex_item.path, url, sha256,
+                                      download.encoding, size, datetime.datetime.now().isoformat(timespec='seconds')))
+
+    def load(self, masterindex_item, temp_dir=None):
+        # FilingDownload with the cached content in a temporary file, None if the filing is not cached
+        with self._lock:
+            row = self._connection.execute('SELECT sha256, encoding FROM response '
+                                           'WHERE cik = ? AND form = ? AND filingdate = ? AND path = ?',
+                                           (int(masterindex_item.cik), masterindex_item.form,
+                                            int(masterindex_item.filingdate), masterindex_item.path)).fetchone()
+        if row is None or not os.path.exists(self.object_path(row[0])):
+            return None
+
+        fd, path = tempfile.mkstemp(suffix='.download', dir=temp_dir)
+        decompressor = zlib.decompressobj()
+        with os.fdopen(fd, 'wb') as out, open(self.object_path(row[0]), 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                out.write(decompressor.decompress(chunk))
+            out.write(decompressor.flush())
+        return FilingDownload(path, 'OK', row[1], row[0])
+
+    def records(self, bgnyear, endyear, bgnqtr=1, endqtr=4, forms=None, ciks=None):
+        # Master index records of the cached filings in the window, per quarter sorted like master.idx
+        with self._lock:
+            rows = self._connection.execute('SELECT cik, name, form, filingdate, path FROM response '
+                                            'WHERE filingdate BETWEEN ? AND ? '
+                                            'ORDER BY filingdate / 10000, (filingdate / 100 % 100 + 2) / 3, '
+                                            'cik, name, form, filingdate, path',
+                                            (int(bgnyear) * 10000, int(endyear) * 10000 + 1231)).fetchall()
+        forms = None if forms is None else set(forms)
+        ciks = None if ciks is None else {int(cik) for cik in ciks}
+        records = []
+        for cik, name, form, filingdate, path in rows:
+            qtr = (filingdate // 100 % 100 - 1) // 3 + 1
+            if not bgnqtr <= qtr <= endqtr:
+                continue
+            if (forms is not None and form not in forms) or (ciks is not None and cik not in ciks):
+                continue
+            records.append(MasterIndexRecord.from_values(cik, name, form, filingdate, path))
+        return records
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def quarter_of(filingdate):
+    # (year, qtr) of a filing date YYYYMMDD or datetime.date
+    if isinstance(filingdate, datetime.date):
+        return filingdate.year, (filingdate.month - 1) // 3 + 1
+    return filingdate // 10000, (filingdate // 100 % 100 - 1) // 3 + 1
+
+
+def quarters_between(first, last):
+    # (year, qtr) tuples from quarter first to quarter last
+    quarters = []
+    year, qtr = first
+    while (year, qtr) <= last:
+        quarters.append((year, qtr))
+        year, qtr = (year + 1, 1) if qtr == 4 else (year, qtr + 1)
+    return quarters
+
+
+class CrawlWatermark:
+    # Watermarks of incremental (delta) crawls, one per form set and CIK universe, so a nightly run
+    # only reads the master index quarters since its last run and scrapes the entries added since then
+    #   last_filingdate = latest filing date of the master index entries already crawled
+    #   seen = paths of the crawled entries with last_filingdate, the day can get more entries later
+    #   retry = entries whose scraping did not finish (e.g. DOWNLOADINGERROR), listed again by the next
+    #           crawls with their number of attempts, until max_attempts crawls failed
+
+    def __init__(self, db_file, max_attempts=3):
+        self.db_file = db_file
+        self.max_attempts = max_attempts
+        self._connection = sqlite3.connect(db_file)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS watermark ('
+                                     'key TEXT PRIMARY KEY, forms TEXT, cik_count INTEGER, '
+                                     'last_filingdate INTEGER, seen TEXT, retry TEXT, updated TEXT)')
+
+    @staticmethod
+    def universe_key(forms, ciks):
+        # Key of a form set and CIK universe, independent of their order
+        universe = [sorted(set(forms)), sorted(set(int(cik) for cik in ciks))]
+        return hashlib.sha1(json.dumps(universe).encode('utf-8')).hexdigest()
+
+    def get(self, forms, ciks):
+        # Watermark of the form set and CIK universe as dict, None before the first crawl
+        #   attempts = (cik, form, filingdate, path) -> failed crawls of each entry to retry
+        row = self._connection.execute('SELECT last_filingdate, seen, retry FROM watermark WHERE key = ?',
+                                       (self.universe_key(forms, ciks),)).fetchone()
+        if row is None:
+            return None
+        retry, attempts = [], {}
+        # Retry entries: cik, name, form, filingdate, path, attempts (not stored by older versions)
+        for values in json.loads(row[2]):
+            entry = MasterIndexRecord.from_values(*values[:5])
+            retry.append(entry)
+            attempts[(entry.cik, entry.form, entry.filingdate, entry.path)] = values[5] if len(values) > 5 else 1
+        return {'last_filingdate': row[0], 'seen': set(json.loads(row[1])), 'retry': retry, 'attempts': attempts}
+
+    def quarters(self, watermark, today=None):
+        # Master index quarters from the quarter of the watermark to the current quarter,
+        # the entries to retry are listed by new_entries without their quarters
+        today = datetime.date.today() if today is None else today
+        return quarters_between(quarter_of(watermark['last_filingdate']), quarter_of(today))
+
+    def new_entries(self, masterindex, watermark):
+        # Entries after the watermark and the entries to retry, in master index order
+        last_filingdate, seen = watermark['last_filingdate'], watermark['seen']
+        entries = [entry for entry in masterindex
+                   if entry.filingdate > last_filingdate or
+                   (entry.filingdate == last_filingdate and entry.path not in seen)]
+        listed = {(entry.cik, entry.form, entry.filingdate, entry.path) for entry in entries}
+        return [entry for entry in watermark['retry']
+                if (entry.cik, entry.form, entry.filingdate, entry.path) not in listed] + entries
+
+    def update(self, forms, ciks, entries, unfinished, last_quarter):
+        # Move the watermark past the crawled entries, unfinished entries are retried by the next crawl
+        # unless they failed in max_attempts crawls
+        # last_quarter = last (year, qtr) of the crawl; without any entries so far the next crawl
+        #   starts with this quarter
+        watermark = self.get(forms, ciks)
+        if watermark is None:
+            year, qtr = last_quarter
+            quarter_start = datetime.date(year, 3 * qtr - 2, 1) - datetime.timedelta(days=1)
+            last_filingdate, seen, attempts = int(quarter_start.strftime('%Y%m%d')), set(), {}
+        else:
+            last_filingdate, seen, attempts = watermark['last_filingdate'], watermark['seen'], watermark['attempts']
+        for entry in entries:
+            if entry.filingdate > last_filingdate:
+                last_filingdate, seen = entry.filingdate, set()
+            if entry.filingdate == last_filingdate:
+                seen.add(entry.path)
+
+        retry = []
+        for entry in unfinished:
+            entry_attempts = attempts.get((entry.cik, entry.form, entry.filingdate, entry.path), 0) + 1
+            if entry_attempts >= self.max_attempts:
+                print('Watermark: {0} failed in {1} crawls, not retried'.format(entry.path, entry_attempts))
+                continue
+            retry.append([entry.cik, entry.name, entry.form, entry.filingdate, entry.path, entry_attempts])
+        with self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO watermark VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     (self.universe_key(forms, ciks), json.dumps(sorted(set(forms))),
+                                      len(set(ciks)), last_filingdate, json.dumps(sorted(seen)), json.dumps(retry),
+                                      datetime.datetime.now().isoformat(timespec='seconds')))
+
+    def close(self):
+        self._connection.close()
 
-def Download_forms(PARM_PATH, PARM_LOGFILE, PARM_BGNYEAR, 
-                   PARM_ENDYEAR, PARM_BGNQTR, PARM_ENDQTR, 
-                   PARM_FORMS, PARM_CIK):
-    # Main Executions Routine
+
+def open_crawl_watermark(PARM_WATERMARK):
+    # Crawl watermarks from a sqlite file name, None for crawls of the whole window
+    if PARM_WATERMARK is None or isinstance(PARM_WATERMARK, CrawlWatermark):
+        return PARM_WATERMARK
+    return CrawlWatermark(PARM_WATERMARK)
+
+#
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * +
+# Daily index
+#   EDGAR posts a master index of each business day's filings in the daily-index directory
+#   (YYYY/QTRn/master.YYYYMMDD.idx), long before the quarterly master.zip lists them.
+
+def daily_index_url(date, root_path=None):
+    # URL or path of the daily master index of a date
+    PARM_ROOT_PATH = 'https://www.sec.gov/Archives/edgar/daily-index/' if root_path is None else root_path
+    year, qtr = quarter_of(date)
+    append_path = '{0}/QTR{1}/master.{2}.idx'.format(year, qtr, date.strftime('%Y%m%d'))
+    if not PARM_ROOT_PATH.startswith(('http://', 'https://')):
+        return os.path.join(PARM_ROOT_PATH, *append_path.split('/'))
+    return PARM_ROOT_PATH + append_path
+
+
+class DailyIndexSource:
+    # Daily master index files from EDGAR or from a local directory with the same layout
+    #   root = daily-index root URL, or directory (e.g. a local stand-in for tests); by default EDGAR
+
+    def __init__(self, root=None, transport=None):
+        self.root = root
+        self.transport = transport
+
+    def fetch(self, date):
+        # Content of the daily index of a date, None if it is not posted (yet);
+        # other failures (e.g. throttling, server errors, no response) raise requests.RequestException
+        url = daily_index_url(date, self.root)
+        if not url.startswith(('http://', 'https://')):
+            try:
+                with open(url, 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+
+        transport = TRANSPORT if self.transport is None else self.transport
+        response = transport.get(url, number_of_tries = 3, timeout = 60, verbose = False)
+        if response is None:
+            raise requests.ConnectionError('no response for {0}'.format(url))
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.content
+
+    def entries(self, date, forms=None, ciks=None):
+        # Master index records of the daily index filtered by form and CIK, None if it is not posted
+        content = self.fetch(date)
+        if content is None:
+            return None
+        df = parse_daily_index(content, forms, ciks)
+        print('Daily index {0} | len() = {1:,} | selected = {2:,}'.format(date.isoformat(), df.attrs['records'], len(df)))
+        return frame_to_masterindex(df)
+
+
+def Poll_daily_index(PARM_PATH, PARM_LOGFILE, PARM_FORMS, PARM_CIK,
+                     PARM_WATERMARK=None, PARM_DAILY_INDEX_ROOT=None,
+                     PARM_START_DATE=None, PARM_POLL_INTERVAL=60, PARM_MAX_POLLS=None, PARM_GRACE_DAYS=3,
+                     PARM_CONCURRENCY=1, PARM_PARSE_PROCESSES=None, PARM_SPLIT_DOCUMENTS=False,
+                     PARM_PRIMARY_DOCUMENT_CACHE=None, PARM_MAX_FILING_SIZE=None, PARM_LAZY_TEXT=False,
+                     PARM_TEXT_STORE=None, PARM_RAW_CACHE=None, PARM_DEDUPLICATE=False,
+                     PARM_PARAGRAPH_STORE=None):
+    # Poll the daily indexes and scrape the new filings of PARM_FORMS and PARM_CIK as soon as their
+    # daily index is posted; yields (date of the daily index, result) with the columns RESULT_COLUMNS
+    # PARM_WATERMARK = sqlite file of the CrawlWatermark, shared with incremental crawls of Download_forms
+    #   (None = kept in memory, a restarted loop then starts again at PARM_START_DATE)
+    # PARM_DAILY_INDEX_ROOT = daily-index root URL or local directory (None = EDGAR)
+    # PARM_START_DATE = first day to poll, by default the day of the watermark or today
+    # PARM_POLL_INTERVAL = seconds between polls, PARM_MAX_POLLS = number of polls (None = poll forever)
+    # PARM_GRACE_DAYS = days after which a day without daily index (404, e.g. weekend, holiday) is no
+    #   longer polled; a day whose daily index fails otherwise is polled until it is read
+    # (see Download_forms for the other parameters)
+    # Each day is fetched until its daily index is posted; posted daily indexes are final and read once
+
+    source = DailyIndexSource(PARM_DAILY_INDEX_ROOT)
+    watermarks = open_crawl_watermark(PARM_WATERMARK if PARM_WATERMARK is not None else ':memory:')
+    watermark = watermarks.get(PARM_FORMS, PARM_CIK)
+
+    cursor = PARM_START_DATE
+    if cursor is None and watermark is not None:
+        cursor = datetime.datetime.strptime(str(watermark['last_filingdate']), '%Y%m%d').date()
+    if cursor is None:
+        cursor = datetime.date.today()
+    finished_days = set()
+    # Scraped entries of days after a pending day, the watermark moves past them with the cursor
+    ahead = []
+
+    n_polls = 0
+    try:
+        while PARM_MAX_POLLS is None or n_polls < PARM_MAX_POLLS:
+            n_polls += 1
+            today = datetime.date.today()
+
+            # Entries of the daily indexes posted since the last poll
+            entries = []
+            posted_days = []
+            day = cursor
+            while day <= today:
+                if day not in finished_days:
+                    try:
+                        day_entries = source.entries(day, PARM_FORMS, PARM_CIK)
+                    except (requests.RequestException, OSError) as exc:
+                        # Not known to be missing, the day is polled again
+                        print('Daily index {0} | Warning: {1}'.format(day.isoformat(), str(exc)))
+                        day += datetime.timedelta(days=1)
+                        continue
+                    if day_entries is not None:
+                        entries.extend(day_entries)
+                        posted_days.append(day)
+                        finished_days.add(day)
+                    elif (today - day).days > PARM_GRACE_DAYS:
+                        finished_days.add(day)
+                day += datetime.timedelta(days=1)
+            while cursor in finished_days and cursor < today:
+                finished_days.discard(cursor)
+                cursor += datetime.timedelta(days=1)
+
+            if posted_days:
+                watermark = watermarks.get(PARM_FORMS, PARM_CIK)
+                if watermark is not None:
+                    entries = watermarks.new_entries(entries, watermark)
+                print('Poll {0}: {1:,} new filings in the daily indexes of {2}'.format(
+                    n_polls, len(entries), ', '.join(day.isoformat() for day in posted_days)))
+
+                unfinished = []
+                if entries:
+                    for _, result in Iterate_forms(PARM_PATH, PARM_LOGFILE, posted_days[-1].year,
+                                                   posted_days[-1].year, 1, 4, PARM_FORMS, PARM_CIK,
+                                                   PARM_CONCURRENCY, None, PARM_PARSE_PROCESSES,
+                                                   PARM_SPLIT_DOCUMENTS, PARM_PRIMARY_DOCUMENT_CACHE,
+                                                   PARM_MAX_FILING_SIZE, PARM_LAZY_TEXT = PARM_LAZY_TEXT,
+                                                   PARM_TEXT_STORE = PARM_TEXT_STORE,
+                                                   PARM_RAW_CACHE = PARM_RAW_CACHE,
+                                                   PARM_DEDUPLICATE = PARM_DEDUPLICATE,
+                                                   PARM_PARAGRAPH_STORE = PARM_PARAGRAPH_STORE,
+                                                   PARM_MASTERINDEX = entries):
+                        if str(result[9]) not in CRAWL_FINISHED_STATUSES:
+                            unfinished.append(MasterIndexRecord.from_values(*result[:5]))
+                        yield posted_days[-1], result
+
+                # The watermark only moves up to the first pending day, otherwise the entries of a day
+                # whose daily index is read late would be older than the watermark and dropped
+                ahead.extend(entries)
+                first_pending = int(cursor.strftime('%Y%m%d'))
+                crawled = [entry for entry in ahead if entry.filingdate < first_pending]
+                ahead = [entry for entry in ahead if entry.filingdate >= first_pending]
+                watermarks.update(PARM_FORMS, PARM_CIK, crawled, unfinished, quarter_of(posted_days[-1]))
+
+            if PARM_MAX_POLLS is None or n_polls < PARM_MAX_POLLS:
+                time.sleep(PARM_POLL_INTERVAL)
+    finally:
+        watermarks.close()
+
+
+def open_raw_cache(PARM_RAW_CACHE):
+    # Raw response cache from a directory name, None if no raw responses should be kept
+    if PARM_RAW_CACHE is None or isinstance(PARM_RAW_CACHE, RawResponseCache):
+        return PARM_RAW_CACHE
+    return RawResponseCache(PARM_RAW_CACHE)
+#
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * +
+# Compressed text store
+#   Instead of one file per text, the output texts can be stored as zlib compressed
+#   records in append-only shard files, partitioned by year and quarter of the filing date:
+#       store_dir/year=YYYY/qtr=Q/shard-{pid}.dat   records appended by one process each
+#       store_dir/year=YYYY/qtr=Q/shard-{pid}.idx   one JSON line per record: name, offset, length, size, time
+#   Texts are addressed by their output file name, e.g. 20221028_10-K_..._FullText_1.txt,
+#   a later record with the same name replaces the earlier one.
+
+# Record: header length, compressed length, JSON header {"name", "size"}, compressed text
+RECORD_PREFIX = struct.Struct('>II')
+
+
+class ShardedTextStore:
+    def __init__(self, store_dir, compresslevel=6):
+        self.store_dir = store_dir
+        self.compresslevel = compresslevel
+        self._lock = threading.Lock()
+        # partition -> (data file, index file) of this process
+        self._shards = {}
+        self._shards_pid = os.getpid()
+        # partition -> {name: (shard, offset, length, size, time)} and read positions of the index files
+        self._indexes = {}
+        self._index_positions = {}
+
+    def __getstate__(self):
+        # Open files are not passed to worker processes
+        return {'store_dir': self.store_dir, 'compresslevel': self.compresslevel}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def partition(self, name):
+        # Directory of the partition of a name starting with the filing date (YYYYMMDD)
+        date = name[:8]
+        if not date.isdigit():
+            return os.path.join(self.store_dir, 'other')
+        qtr = (int(date[4:6]) - 1) // 3 + 1
+        return os.path.join(self.store_dir, 'year=' + date[:4], 'qtr=' + str(qtr))
+
+    def _shard(self, partition):
+        # Shard files of this process, processes never append to the same shard
+        if self._shards_pid != os.getpid():
+            self._shards = {}
+            self._shards_pid = os.getpid()
+        if partition not in self._shards:
+            os.makedirs(partition, exist_ok=True)
+            shard = 'shard-' + str(os.getpid())
+            self._shards[partition] = (open(os.path.join(partition, shard + '.dat'), 'ab'),
+                                       open(os.path.join(partition, shard + '.idx'), 'a', encoding='utf-8'))
+        return self._shards[partition]
+
+    def put(self, name, text):
+        data = text.encode('utf-8') if isinstance(text, str) else text
+        header = json.dumps({'name': name, 'size': len(data)}).encode('utf-8')
+        compressed = zlib.compress(data, self.compresslevel)
+        record = RECORD_PREFIX.pack(len(header), len(compressed)) + header + compressed
+
+        partition = self.partition(name)
+        with self._lock:
+            data_file, index_file = self._shard(partition)
+            offset = data_file.seek(0, os.SEEK_END)
+            data_file.write(record)
+            data_file.flush()
+            # The index line is written after the record, so it never points to an incomplete record
+            shard = os.path.basename(data_file.name)
+            index_file.write(json.dumps([name, shard, offset, len(record), len(data), time.time()]) + '\n')
+            index_file.flush()
+
+    def _index(self, partition):
+        # Index of a partition, updated with the index lines written since the last call
+        index = self._indexes.setdefault(partition, {})
+        if not os.path.isdir(partition):
+            return index
+        for file in os.listdir(partition):
+            if not file.endswith('.idx'):
+                continue
+            index_path = os.path.join(partition, file)
+            position = self._index_positions.get(index_path, 0)
+            if os.path.getsize(index_path) <= position:
+                continue
+            with open(index_path, 'r', encoding='utf-8') as f:
+                f.seek(position)
+                for line in f:
+                    if not line.endswith('\n'):
+                        # Line still being written
+                        break
+                    name, shard, offset, length, size, written = json.loads(line)
+                    if name not in index or index[name][4] <= written:
+                        index[name] = (shard, offset, length, size, written)
+                    position += len(line.encode('utf-8'))
+            self._index_positions[index_path] = position
+        return index
+
+    def lookup(self, name):
+        # (shard, offset, length, size, time) of the current record of name, None if not stored
+        partition = self.partition(name)
+        with self._lock:
+            return self._index(partition).get(name)
+
+    def __contains__(self, name):
+        return self.lookup(name) is not None
+
+    def size(self, name):
+        # Uncompressed size in bytes, None if not stored
+        entry = self.lookup(name)
+        return None if entry is None else entry[3]
+
+    def get_bytes(self, name):
+        entry = self.lookup(name)
+        if entry is None:
+            raise KeyError(name)
+        shard, offset, length = entry[:3]
+        with open(os.path.join(self.partition(name), shard), 'rb') as f:
+            f.seek(offset)
+            record = f.read(length)
+        header_length, _ = RECORD_PREFIX.unpack_from(record)
+        return zlib.decompress(record[RECORD_PREFIX.size + header_length:])
+
+    def get(self, name):
+        return self.get_bytes(name).decode('utf-8')
+
+    def partitions(self):
+        partitions = []
+        for root, dirs, files in os.walk(self.store_dir):
+            if any(file.endswith('.dat') for file in files):
+                partitions.append(root)
+        return sorted(partitions)
+
+    def names(self):
+        # Names of all stored texts
+        names = []
+        for partition in self.partitions():
+            with self._lock:
+                names.extend(self._index(partition))
+        return names
+
+    def scan(self, year=None, qtr=None):
+        # Yield (name, text) of the current records, reading the shard files sequentially
+        # year, qtr = only the partition of this year and quarter
+        for partition in self.partitions():
+            if year is not None and os.path.join('year=' + str(year), '') not in partition + os.sep:
+                continue
+            if qtr is not None and not partition.endswith('qtr=' + str(qtr)):
+                continue
+            with self._lock:
+                index = dict(self._index(partition))
+            for file in sorted(os.listdir(partition)):
+                if not file.endswith('.dat'):
+                    continue
+                with open(os.path.join(partition, file), 'rb') as f:
+                    offset = 0
+                    while True:
+                        prefix = f.read(RECORD_PREFIX.size)
+                        if len(prefix) < RECORD_PREFIX.size:
+                            break
+                        header_length, compressed_length = RECORD_PREFIX.unpack(prefix)
+                        header = f.read(header_length)
+                        compressed = f.read(compressed_length)
+                        if len(compressed) < compressed_length:
+                            # Incomplete record at the end of the shard
+                            break
+                        name = json.loads(header)['name']
+                        entry = index.get(name)
+                        # Skip records replaced by a later record and records without index line
+                        if entry is not None and entry[0] == file and entry[1] == offset:
+                            yield name, zlib.decompress(compressed).decode('utf-8')
+                        offset += RECORD_PREFIX.size + header_length + compressed_length
+
+    def close(self):
+        with self._lock:
+            for data_file, index_file in self._shards.values():
+                data_file.close()
+                index_file.close()
+            self._shards = {}
+
+
+def open_text_store(PARM_TEXT_STORE):
+    # Text store from a directory name, None if the texts are written as files
+    if PARM_TEXT_STORE is None or isinstance(PARM_TEXT_STORE, ShardedTextStore):
+        return PARM_TEXT_STORE
+    return ShardedTextStore(PARM_TEXT_STORE)
+
+
+def write_output(fname, text, store=None):
+    # Write an output text to its file, or to the store under the file name
+    if store is not None:
+        store.put(os.path.basename(fname), text)
+        return
+    with open(fname, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def read_output(fname, store=None):
+    # Read an output text from its file or the store
+    if store is not None:
+        return store.get(os.path.basename(fname))
+    with open(fname, 'r', encoding = 'utf-8') as f:
+        return f.read()
+
+#
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * +
+# Paragraph store
+#   The business description of a firm changes little between years, so the texts can be kept
+#   as unique paragraphs per CIK and one list of paragraph ids per text:
+#       paragraph(id, cik, hash, text)                  each distinct paragraph of a CIK once
+#       document(name, cik, form, filingdate, kind,     texts by output file name, e.g. ..._BusinessDesc_1.txt
+#                paragraph_ids, separators)
+#   The output texts have their whitespace collapsed, so a paragraph is the text up to a sentence
+#   end followed by whitespace; joining the paragraphs with the separators gives the text back exactly.
+#   New and carried-over paragraphs between two texts are set operations on the paragraph ids.
+
+PARAGRAPH_BREAK = re.compile(r'(?<=[.!?])(\s+)(?=\S)')
+# Maximum number of ids in one sqlite IN (...) query
+SQLITE_MAX_VARIABLES = 900
+
+
+def split_paragraphs(text):
+    # Paragraphs of a text and the whitespace between them
+    parts = PARAGRAPH_BREAK.split(text)
+    return parts[0::2], parts[1::2]
+
+
+class ParagraphStore:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._connection = sqlite3.connect(db_file)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS paragraph ('
+                                     'id INTEGER PRIMARY KEY, cik INTEGER NOT NULL, hash BLOB NOT NULL, '
+                                     'text TEXT NOT NULL, UNIQUE (cik, hash))')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS document ('
+                                     'name TEXT PRIMARY KEY, cik INTEGER NOT NULL, form TEXT, filingdate INTEGER, '
+                                     'kind TEXT, paragraph_ids BLOB NOT NULL, separators TEXT, text_hash TEXT)')
+            # Stores of earlier versions have no text hashes, their texts are replaced once
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(document)')]
+            if 'text_hash' not in columns:
+                self._connection.execute('ALTER TABLE document ADD COLUMN text_hash TEXT')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS document_cik ON document (cik, kind, filingdate)')
+
+    def __contains__(self, name):
+        return self._connection.execute('SELECT 1 FROM document WHERE name = ?', (name,)).fetchone() is not None
+
+    def add(self, name, cik, form, filingdate, kind, text):
+        # Store a text under its output file name, kind = 'FullText' or 'BusinessDesc'
+        cik = int(cik)
+        paragraphs, separators = split_paragraphs(text)
+        hashes = [hashlib.sha1(paragraph.encode('utf-8')).digest() for paragraph in paragraphs]
+
+        with self._connection:
+            ids = {}
+            unique_hashes = list(dict.fromkeys(hashes))
+            for i in range(0, len(unique_hashes), SQLITE_MAX_VARIABLES):
+                chunk = unique_hashes[i:i + SQLITE_MAX_VARIABLES]
+                ids.update(self._connection.execute(
+                    'SELECT hash, id FROM paragraph WHERE cik = ? AND hash IN ({0})'.format(', '.join('?' * len(chunk))),
+                    [cik] + chunk).fetchall())
+            for paragraph, paragraph_hash in zip(paragraphs, hashes):
+                if paragraph_hash not in ids:
+                    ids[paragraph_hash] = self._connection.execute(
+                        'INSERT INTO paragraph (cik, hash, text) VALUES (?, ?, ?)',
+                        (cik, paragraph_hash, paragraph)).lastrowid
+
+            # Separators are only kept if they are not all single spaces
+            self._connection.execute('INSERT OR REPLACE INTO document (name, cik, form, filingdate, kind, '
+                                     'paragraph_ids, separators, text_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                     (name, cik, form, int(filingdate), kind,
+                                      array.array('q', [ids[h] for h in hashes]).tobytes(),
+                                      None if all(sep == ' ' for sep in separators) else json.dumps(separators),
+                                      text_hash(text)))
+
+    def add_result(self, result):
+        # Store the full text and business description of a result row (see RESULT_COLUMNS)
+        # that are not stored yet or changed, e.g. after a reparse
+        fname, count = os.path.basename(result[6]), result[5]
+        for kind, value in (('FullText', result[7]), ('BusinessDesc', result[8])):
+            if not value:
+                continue
+            name = fname.replace('.txt', '_' + kind + '_' + str(count) + '.txt')
+            text = text_of(value)
+            if self.stored_hash(name) != text_hash(text):
+                self.add(name, result[0], result[2], result[3], kind, text)
+
+    def stored_hash(self, name):
+        # sha1 of a stored text, None if the text is not stored
+        row = self._connection.execute('SELECT text_hash FROM document WHERE name = ?', (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def paragraph_ids(self, name):
+        # Paragraph ids of a stored text in text order, None if the text is not stored
+        row = self._connection.execute('SELECT paragraph_ids FROM document WHERE name = ?', (name,)).fetchone()
+        return None if row is None else array.array('q', row[0]).tolist()
+
+    def paragraphs(self, ids):
+        # Texts of paragraph ids in the given order
+        texts = {}
+        unique_ids = list(set(ids))
+        for i in range(0, len(unique_ids), SQLITE_MAX_VARIABLES):
+            chunk = unique_ids[i:i + SQLITE_MAX_VARIABLES]
+            texts.update(self._connection.execute(
+                'SELECT id, text FROM paragraph WHERE id IN ({0})'.format(', '.join('?' * len(chunk))), chunk).fetchall())
+        return [texts[paragraph_id] for paragraph_id in ids]
+
+    def get(self, name):
+        # Reconstructed text, None if the text is not stored
+        row = self._connection.execute('SELECT paragraph_ids, separators FROM document WHERE name = ?',
+                                       (name,)).fetchone()
+        if row is None:
+            return None
+        paragraphs = self.paragraphs(array.array('q', row[0]).tolist())
+        separators = json.loads(row[1]) if row[1] is not None else [' '] * (len(paragraphs) - 1)
+        parts = [paragraphs[0]]
+        for separator, paragraph in zip(separators, paragraphs[1:]):
+            parts.append(separator)
+            parts.append(paragraph)
+        return ''.join(parts)
+
+    def documents(self, cik, kind='BusinessDesc', form=None):
+        # (name, form, filingdate) of the stored texts of a CIK, ordered by filing date
+        query = 'SELECT name, form, filingdate FROM document WHERE cik = ? AND kind = ?'
+        parameters = [int(cik), kind]
+        if form is not None:
+            query += ' AND form = ?'
+            parameters.append(form)
+        return self._connection.execute(query + ' ORDER BY filingdate, name', parameters).fetchall()
+
+    def changes(self, name, previous):
+        # Paragraph ids of text name that are new and carried over compared with text previous
+        # (None = no previous text, all paragraphs are new), in text order
+        ids = self.paragraph_ids(name)
+        previous_ids = set(self.paragraph_ids(previous) or ()) if previous is not None else set()
+        return ([paragraph_id for paragraph_id in ids if paragraph_id not in previous_ids],
+                [paragraph_id for paragraph_id in ids if paragraph_id in previous_ids])
+
+    def change_frame(self, cik, kind='BusinessDesc', form=None):
+        # New and carried-over paragraphs of each text of a CIK compared with the CIK's previous text
+        rows = []
+        previous = None
+        for name, doc_form, filingdate in self.documents(cik, kind, form):
+            new, carried = self.changes(name, previous)
+            rows.append([int(cik), doc_form, filingdate, name, len(new) + len(carried), len(new), len(carried)])
+            previous = name
+        return pd.DataFrame(rows, columns = ['CIK', 'FORM', 'FILINGDATE', 'NAME',
+                                             'PARAGRAPHS', 'NEW_PARAGRAPHS', 'CARRIED_PARAGRAPHS'])
+
+    def close(self):
+        self._connection.close()
+
+
+def open_paragraph_store(PARM_PARAGRAPH_STORE):
+    # Paragraph store from a sqlite file name, None if the texts should not be stored as paragraphs
+    if PARM_PARAGRAPH_STORE is None or isinstance(PARM_PARAGRAPH_STORE, ParagraphStore):
+        return PARM_PARAGRAPH_STORE
+    return ParagraphStore(PARM_PARAGRAPH_STORE)
+
+#
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * +
+# Scraped document manifest
+
+MANIFEST_NAME = 'EDGAR_Scraping_Manifest.sqlite'
+# Output files written by Parse_filing_to_doc, e.g. {fpath}_FullText_1.txt
+OUTPUT_FILE_PATTERN = re.compile(r'^(.+)_(RawText|FullText|BusinessDesc|ItemIndex)_(\d+)\.(?:txt|json)$')
+OUTPUT_FILE_KINDS = ('RawText', 'FullText', 'BusinessDesc', 'ItemIndex')
+# Statuses of filings whose output files are complete, other filings are scraped again
+FINISHED_STATUSES = ('True', 'PARSINGERROR')
+# Statuses of filings that incremental crawls do not retry, an oversized filing stays oversized
+CRAWL_FINISHED_STATUSES = FINISHED_STATUSES + ('OVERSIZED',)
+MANIFEST_COLUMNS = ('fpath', 'file_count', 'fname', 'raw_file', 'full_text_file', 'business_desc_file',
+                    'item_index_file', 'raw_size', 'full_text_size', 'business_desc_size',
+                    'full_text_hash', 'business_desc_hash', 'status',
+                    'raw_hash', 'original_fpath', 'original_file_count')
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class ScrapeManifest:
+    # Manifest of the scraped filings of an output directory, so that resuming is
+    # one indexed lookup per filing instead of scanning the directory
+    #   key = file name of the filing without '.txt' (fpath) and its file count
+    #   files, sizes and sha1 hashes of the full text and business description, status (WORKED column)
+    # A missing manifest is rebuilt from the files in the directory
+    # store = ShardedTextStore holding the output texts instead of the directory
+    # deduplicate = True lets filings with the same full text as an earlier filing reference the
+    #   output files of that filing (original_fpath, original_file_count) instead of keeping their own;
+    #   raw_hash is the sha256 of the downloaded content, used to skip parsing identical downloads
+    # Duplicates have no output files of their own, a rebuilt manifest does not contain them
+
+    def __init__(self, path_dir, manifest_file=None, store=None, deduplicate=False):
+        self.path_dir = path_dir
+        self.store = store
+        self.deduplicate = deduplicate
+        # full text hash -> manifest row of the first filing with this text, scraped in this session
+        self._originals = {}
+        if manifest_file is None:
+            manifest_file = os.path.join(path_dir, MANIFEST_NAME)
+        rebuild = not os.path.exists(manifest_file)
+
+        self._connection = sqlite3.connect(manifest_file)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS filing ('
+                'fpath TEXT NOT NULL, file_count INTEGER NOT NULL, fname TEXT, '
+                'raw_file TEXT, full_text_file TEXT, business_desc_file TEXT, item_index_file TEXT, '
+                'raw_size INTEGER, full_text_size INTEGER, business_desc_size INTEGER, '
+                'full_text_hash TEXT, business_desc_hash TEXT, status TEXT, '
+                'raw_hash TEXT, original_fpath TEXT, original_file_count INTEGER, '
+                'PRIMARY KEY (fpath, file_count))')
+            # Manifests of earlier versions have no deduplication columns
+            columns = [row[1] for row in self._connection.execute('PRAGMA table_info(filing)')]
+            for column, column_type in (('raw_hash', 'TEXT'), ('original_fpath', 'TEXT'),
+                                        ('original_file_count', 'INTEGER')):
+                if column not in columns:
+                    self._connection.execute('ALTER TABLE filing ADD COLUMN {0} {1}'.format(column, column_type))
+            self._connection.execute('CREATE INDEX IF NOT EXISTS filing_full_text_hash ON filing (full_text_hash)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS filing_raw_hash ON filing (raw_hash)')
+        if rebuild:
+            self.rebuild()
+
+    def output_file(self, fpath, kind, file_count):
+        return fpath + '_' + kind + '_' + str(file_count) + ('.json' if kind == 'ItemIndex' else '.txt')
+
+    def output_size(self, name):
+        # Size of an output file in bytes, None if it was not written
+        if self.store is not None:
+            return self.store.size(name)
+        path = os.path.join(self.path_dir, name)
+        return os.path.getsize(path) if os.path.exists(path) else None
+
+    def _row(self, fpath, file_count, full_text, business_desc, status, raw_hash=None):
+        # Manifest row of a filing, output files that were not written are None
+        files = {}
+        sizes = {}
+        for kind in OUTPUT_FILE_KINDS:
+            name = self.output_file(fpath, kind, file_count)
+            sizes[kind] = self.output_size(name)
+            files[kind] = name if sizes[kind] is not None else None
+        raw_size = sizes['RawText']
+        full_text_size = len(full_text.encode('utf-8')) if files['FullText'] else None
+        business_desc_size = len(business_desc.encode('utf-8')) if files['BusinessDesc'] else None
+
+        return (fpath, int(file_count), fpath + '.txt',
+                files['RawText'], files['FullText'], files['BusinessDesc'], files['ItemIndex'],
+                raw_size, full_text_size, business_desc_size,
+                text_hash(full_text) if files['FullText'] else None,
+                text_hash(business_desc) if files['BusinessDesc'] else None,
+                str(status), raw_hash, None, None)
+
+    def row(self, result, raw_hash=None):
+        # Manifest row of a result row of Parse_filing_to_doc
+        fpath = os.path.basename(result[6]).replace('.txt', '')
+        row = dict(zip(MANIFEST_COLUMNS, self._row(fpath, result[5], result[7], result[8], result[9], raw_hash)))
+        if self.deduplicate and row['status'] in FINISHED_STATUSES:
+            full_text_hash = text_hash(result[7])
+            original = self.find_original(full_text_hash, fpath, row['file_count'])
+            if original is not None:
+                row = self._duplicate_row(row, original)
+            elif row['full_text_file'] is not None:
+                self._originals[full_text_hash] = row
+        return tuple(row[column] for column in MANIFEST_COLUMNS)
+
+    def find_original(self, full_text_hash, fpath, file_count):
+        # First filing other than fpath/file_count with this full text and its own output files, or None
+        original = self._originals.get(full_text_hash)
+        if original is not None and (original['fpath'], original['file_count']) != (fpath, file_count):
+            return original
+        cursor = self._connection.execute(
+            'SELECT * FROM filing WHERE full_text_hash = ? AND original_fpath IS NULL AND full_text_file IS NOT NULL '
+            'AND NOT (fpath = ? AND file_count = ?) ORDER BY rowid LIMIT 1', (full_text_hash, fpath, file_count))
+        original = cursor.fetchone()
+        return None if original is None else dict(zip([column[0] for column in cursor.description], original))
+
+    def _duplicate_row(self, row, original):
+        # Row referencing the texts of the original, the duplicate's own copies are removed
+        # (texts in a store are append-only and stay unreferenced)
+        for column in ('full_text_file', 'business_desc_file', 'item_index_file'):
+            if row[column] is not None and row[column] != original[column] and self.store is None:
+                os.remove(os.path.join(self.path_dir, row[column]))
+            row[column] = original[column]
+        # The raw texts can differ for the same full text
+        if row['raw_file'] is None:
+            row['raw_file'] = original['raw_file']
+            row['raw_size'] = original['raw_size']
+        for column in ('full_text_size', 'business_desc_size', 'full_text_hash', 'business_desc_hash'):
+            row[column] = original[column]
+        row['original_fpath'] = original['fpath']
+        row['original_file_count'] = original['file_count']
+        return row
+
+    def record_rows(self, rows):
+        # Record manifest rows in one transaction
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO filing VALUES ({0})'.format(
+                ', '.join('?' * len(MANIFEST_COLUMNS))), rows)
+
+    def record(self, results):
+        # Record result rows of Parse_filing_to_doc in one transaction
+        self.record_rows([self.row(result) for result in results])
+
+    def lookup(self, fpath):
+        # Finished filings with this fpath as dicts, ordered by file count
+        cursor = self._connection.execute(
+            'SELECT * FROM filing WHERE fpath = ? AND status IN ({0}) ORDER BY file_count'.format(
+                ', '.join('?' * len(FINISHED_STATUSES))), (fpath,) + FINISHED_STATUSES)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def raw_originals(self):
+        # Raw content hash -> manifest row of the finished filings scraped from that content
+        cursor = self._connection.execute(
+            'SELECT * FROM filing WHERE raw_hash IS NOT NULL AND original_fpath IS NULL AND status IN ({0}) '
+            'ORDER BY rowid'.format(', '.join('?' * len(FINISHED_STATUSES))), FINISHED_STATUSES)
+        columns = [column[0] for column in cursor.description]
+        originals = {}
+        for row in cursor.fetchall():
+            row = dict(zip(columns, row))
+            originals.setdefault(row['raw_hash'], row)
+        return originals
+
+    def duplicates(self):
+        # Filings referencing the output files of an identical filing as
+        # (fpath, file_count, original_fpath, original_file_count) tuples
+        return self._connection.execute('SELECT fpath, file_count, original_fpath, original_file_count FROM filing '
+                                        'WHERE original_fpath IS NOT NULL ORDER BY fpath, file_count').fetchall()
+
+    def rebuild(self):
+        # Rebuild the manifest from the output files in the directory or the store
+        outputs = {}
+        for name in (self.store.names() if self.store is not None else os.listdir(self.path_dir)):
+            match = OUTPUT_FILE_PATTERN.match(name)
+            if match:
+                outputs.setdefault((match.group(1), int(match.group(3))), set()).add(match.group(2))
+
+        results = []
+        for (fpath, file_count), kinds in outputs.items():
+            texts = {}
+            for kind in ('FullText', 'BusinessDesc'):
+                texts[kind] = ''
+                if kind in kinds:
+                    texts[kind] = read_output(os.path.join(self.path_dir, self.output_file(fpath, kind, file_count)),
+                                              self.store)
+
+            # Same status as the scraping, the business description is only written if it was found
+            if texts['BusinessDesc'] != '':
+                status = True
+            elif texts['FullText'] != '':
+                status = "PARSINGERROR"
+            else:
+                status = "DOWNLOADINGERROR"
+            results.append(self._row(fpath, file_count, texts['FullText'], texts['BusinessDesc'], status))
+
+        with self._connection:
+            self._connection.execute('DELETE FROM filing')
+            self._connection.executemany('INSERT INTO filing VALUES ({0})'.format(
+                ', '.join('?' * len(MANIFEST_COLUMNS))), results)
+        print('Manifest rebuilt with {0} filings from {1}'.format(len(results), self.store.store_dir if self.store is not None else self.path_dir))
+
+    def close(self):
+        self._connection.close()
+#
+# * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * * +
+
+RESULT_COLUMNS = ["CIK", "NAME", "FORM", "FILINGDATE", "EDGAR_PATH",
+                  "FILECOUNT", "FILE_PATH", 'Full_Text', 'Business_Description', "WORKED"]
+
+
+class LazyText:
+    # Text of an output file, loaded on demand; str() is the file path,
+    # so status files and DataFrame displays stay small
+    # store = ShardedTextStore holding the text under the file name instead of a file
+
+    def __init__(self, path, store=None):
+        self.path = path
+        self.store = store
+
+    def __str__(self):
+        return self.path
+
+    def __repr__(self):
+        return 'LazyText({0!r})'.format(self.path)
+
+    def __fspath__(self):
+        return self.path
+
+    @property
+    def text(self):
+        return read_output(self.path, self.store)
+
+    def mmap(self):
+        # Read-only memory map of the utf-8 encoded text, b'' for an empty file;
+        # texts in a store are compressed and returned as bytes
+        if self.store is not None:
+            return self.store.get_bytes(os.path.basename(self.path))
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+
+def text_of(value):
+    # Text of a Full_Text or Business_Description value, loading LazyText values
+    return value.text if isinstance(value, LazyText) else value
+
+
+def lazy_result(result, store=None, full_text_file=None, business_desc_file=None):
+    # Result row with LazyText references to the full text and business description files,
+    # by default the files of the row's own file name and count; full_text_file and
+    # business_desc_file are file names in the same directory (e.g. the files of an identical filing)
+    result = list(result)
+    fname, count = result[6], result[5]
+    path_dir = fname[:len(fname) - len(os.path.basename(fname))]
+    if result[7] and not isinstance(result[7], LazyText):
+        result[7] = LazyText(path_dir + full_text_file if full_text_file else
+                             fname.replace('.txt', '_FullText' + '_' + str(count) + '.txt'), store)
+    if result[8] and not isinstance(result[8], LazyText):
+        result[8] = LazyText(path_dir + business_desc_file if business_desc_file else
+                             fname.replace('.txt', '_BusinessDesc' + '_' + str(count) + '.txt'), store)
+    return result
+
+
+class ResultSink:
+    # Writes result rows to the status CSV files as they arrive and records scraped filings
+    # in the manifest; both are flushed every flush_every rows, so an interrupted run keeps its results
+    #   Status_EDGAR_Scraping.csv    = rows appended to the file of previous runs
+    #   Status_EDGAR_Scraping_df.csv = rows of this run, the first column is the position in the master index
+    # lazy_text = True replaces the texts by LazyText file references, the status files then hold file paths
+    # paragraph_store = ParagraphStore receiving the texts that are not stored there yet
+
+    def __init__(self, path_dir, manifest, flush_every=100, col_list=RESULT_COLUMNS, lazy_text=False,
+                 paragraph_store=None):
+        self.manifest = manifest
+        self.flush_every = flush_every
+        self.lazy_text = lazy_text
+        self.paragraph_store = paragraph_store
+        self._status_file = open(path_dir + 'Status_EDGAR_Scraping.csv', "a", newline = '', encoding = 'utf-8')
+        self._df_file = open(path_dir + 'Status_EDGAR_Scraping_df.csv', "w", newline = '', encoding = 'utf-8')
+        self._status_writer = csv.writer(self._status_file)
+        self._df_writer = csv.writer(self._df_file, lineterminator = os.linesep)
+        self._df_writer.writerow([''] + list(col_list))
+        self._scraped = []
+        self._unflushed = 0
+
+    def write(self, position, result, scraped=True, raw_hash=None):
+        # scraped = False for results of an earlier run, which are already in the manifest
+        # raw_hash = sha256 of the downloaded content (see ContentDedup)
+        # Returns the written row
+        files = {}
+        if scraped:
+            row = self.manifest.row(result, raw_hash)
+            self._scraped.append(row)
+            files = dict(zip(MANIFEST_COLUMNS, row))
+        if self.paragraph_store is not None and str(result[9]) in FINISHED_STATUSES:
+            self.paragraph_store.add_result(result)
+        if self.lazy_text:
+            result = lazy_result(result, self.manifest.store,
+                                 files.get('full_text_file'), files.get('business_desc_file'))
+        self._status_writer.writerow(result)
+        self._df_writer.writerow([position] + list(result))
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self.flush()
+        return result
+
+    def flush(self):
+        self._status_file.flush()
+        self._df_file.flush()
+        if self._scraped:
+            self.manifest.record_rows(self._scraped)
+            self._scraped = []
+        self._unflushed = 0
+
+    def close(self):
+        self.flush()
+        self._status_file.close()
+        self._df_file.close()
+
+
+def Iterate_forms(PARM_PATH, PARM_LOGFILE, PARM_BGNYEAR,
+                  PARM_ENDYEAR, PARM_BGNQTR, PARM_ENDQTR,
+                  PARM_FORMS, PARM_CIK, PARM_CONCURRENCY=1,
+                  PARM_MASTERINDEX_STORE=None, PARM_PARSE_PROCESSES=None,
+                  PARM_SPLIT_DOCUMENTS=False, PARM_PRIMARY_DOCUMENT_CACHE=None,
+                  PARM_MAX_FILING_SIZE=None, PARM_FLUSH_EVERY=100, PARM_LAZY_TEXT=False,
+                  PARM_TEXT_STORE=None, PARM_RAW_CACHE=None, PARM_REPARSE=False,
+                  PARM_DEDUPLICATE=False, PARM_PARAGRAPH_STORE=None, PARM_WATERMARK=None,
+                  PARM_MASTERINDEX=None, PARM_QUERY_STRATEGY='auto'):
+    # Scrape the filings like Download_forms, but yield (position, result) tuples as the filings finish
+    # instead of collecting them; position is the index of the filing in the master index listing,
+    # result a row with the columns RESULT_COLUMNS. Already scraped filings are yielded first.
+    # PARM_FLUSH_EVERY sets the number of results after which the status files and manifest are flushed
+    # PARM_LAZY_TEXT = True yields LazyText file references instead of the texts
+    # PARM_REPARSE = True parses all cached filings of the window again from PARM_RAW_CACHE,
+    #   without any network access and without resuming
+    # PARM_WATERMARK makes the crawl incremental, see Download_forms
+    # PARM_MASTERINDEX = list of master index records to scrape instead of the master index of the window
+    #   (e.g. the new entries of the daily indexes, see Poll_daily_index)
+    # (see Download_forms for the other parameters)
 
     # Setup output path and extract already scraped entries
     path = PARM_PATH
 
     # Output CSV files
     csv_result_name = 'Status_EDGAR_Scraping.csv'
-    df_csv_result_name = 'Status_EDGAR_Scraping_df.csv'
-
-    col_list = ["CIK", "NAME", "FORM", "FILINGDATE", "EDGAR_PATH",\
-                "FILECOUNT", "FILE_PATH", 'Full_Text', 'Business_Description', "WORKED"]
-    result_df = pd.DataFrame(columns = col_list)
-
-    existing_document = []
 
     if not os.path.exists(path):
         os.makedirs(path)
@@ -404,7 +3118,7 @@ def Download_forms(PARM_PATH, PARM_LOGFILE, PARM_BGNYEAR,
         # Create Output file CSV file
         with open(path + '//' + csv_result_name, "w", encoding = 'utf-8') as f:
             writer = csv.DictWriter(
-                    f, fieldnames=col_list)
+                    f, fieldnames=RESULT_COLUMNS)
             writer.writeheader()
         f.close()
 
@@ -412,94 +3126,143 @@ def Download_forms(PARM_PATH, PARM_LOGFILE, PARM_BGNYEAR,
 
         print('Path: {0} exists already => Extract already existing files'.format(path))
 
-        existing_document = os.listdir(path)
-
-    path = path + '//'
-
-
-    # Collection of global variables that should live outside of the execution path
-    def initializer(path_dir):
-        global path
-        global file_count
-        # Define the result list as global so it can live independent of the path of the execution
-        global result_list
-        path = path_dir
-        file_count = {}
-        result_list = []
-
-    masterindex = Masterindex_iteratable_download(PARM_LOGFILE, PARM_BGNYEAR,
-                                                  PARM_ENDYEAR, PARM_BGNQTR,
-                                                  PARM_ENDQTR, PARM_FORMS,
-                                                  PARM_CIK)
-
-    # Linear execution
-    initializer(path_dir = path)
-
-    for index_entry in masterindex:
-        print('Scraping now file {0} for {1}, for the filing date {2}'.format(index_entry.form, index_entry.name, index_entry.filingdate))
+    raw_cache = open_raw_cache(PARM_RAW_CACHE)
+    if PARM_REPARSE and raw_cache is None:
+        raise ValueError('PARM_REPARSE requires PARM_RAW_CACHE')
 
-        fpath = (str(index_entry.filingdate) + '_' + index_entry.form.replace('/', '-') + '_' + index_entry.path.replace('/', '_'))
-        fpath = fpath.replace('.txt', '')
+    # Incremental crawls start at the watermark of the form set and CIK universe, the
+    # window only applies to the first crawl; reparse mode neither reads nor moves the watermark
+    watermarks = open_crawl_watermark(PARM_WATERMARK) if not PARM_REPARSE and PARM_MASTERINDEX is None else None
+    watermark = watermarks.get(PARM_FORMS, PARM_CIK) if watermarks is not None else None
 
-        if any(fpath in s for s in existing_document):
-            print('\t file {0} for {1}, for the filing date {2} already in list => Extract Entries'.format(index_entry.form, index_entry.name, index_entry.filingdate))
-
-            # Find files in already scraped text
-            files = [s for s in existing_document if fpath in s]
-
-            file_counts_list = [re.findall(r"_(\d+)\.txt$", s)[0] for s in files]
-            file_counts_list = list(set(file_counts_list))
-
-            for file_counts_listitem in file_counts_list:
-                f_text = ''
-                bd_text = ''
-                for text_path in files:
-                    if ('BusinessDesc' in text_path) and (re.findall(r"_(\d+)\.txt$", text_path)[0] == file_counts_listitem):
-                        text_read = open(path + text_path, 'r', encoding = 'utf-8')
-                        bd_text = text_read.read()
-
-                    if ('FullText' in text_path) and (re.findall(r"_(\d+)\.txt$", text_path)[0] == file_counts_listitem):
-                        text_read = open(path + text_path, 'r', encoding = 'utf-8')
-                        f_text = text_read.read()
-
-                        fid = str(index_entry.cik) + str(index_entry.filingdate) + index_entry.form
-                        if fid in file_count:
-                            file_count[fid] += 1
-                        else:
-                            file_count[fid] = 1
-
-                # Adjust error message
-                if bd_text != '':
-                    error_message = True
-                else:
-                    if f_text != '':
-                        error_message = "PARSINGERROR"
-                    else:
-                        error_message = "DOWNLOADINGERROR"
+    # Already scraped filings
+    store = open_text_store(PARM_TEXT_STORE)
+    manifest = ScrapeManifest(path, store = store, deduplicate = PARM_DEDUPLICATE)
+    # In reparse mode the filings of earlier runs are parsed again, so only this run's results are reused
+    dedup = None
+    if PARM_DEDUPLICATE:
+        dedup = ContentDedup({} if PARM_REPARSE else manifest.raw_originals())
 
-                # Add to result list
-                append_item = [index_entry.cik, index_entry.name, index_entry.form,
-                                    index_entry.filingdate, index_entry.path, file_counts_listitem, text_path,
-                                    f_text, bd_text, error_message]
-                result_list.append(append_item)
-                result_df.loc[len(result_df)] = append_item
+    path = path + '//'
+    paragraph_store = open_paragraph_store(PARM_PARAGRAPH_STORE)
+    resolver = open_primary_document_resolver(PARM_PRIMARY_DOCUMENT_CACHE)
+    sink = ResultSink(path, manifest, PARM_FLUSH_EVERY, lazy_text = PARM_LAZY_TEXT,
+                      paragraph_store = paragraph_store)
 
+    try:
+        if PARM_MASTERINDEX is not None:
+            masterindex = PARM_MASTERINDEX
+        elif PARM_REPARSE:
+            # Filings of the window in the cache, the master index is not needed
+            masterindex = raw_cache.records(PARM_BGNYEAR, PARM_ENDYEAR, PARM_BGNQTR, PARM_ENDQTR,
+                                            PARM_FORMS, PARM_CIK)
+        elif watermark is not None:
+            # Delta crawl: the quarters since the watermark and only the entries after it
+            print('Incremental crawl after the filing date {0}'.format(watermark['last_filingdate']))
+            quarters = watermarks.quarters(watermark)
+            masterindex = Masterindex_query(PARM_LOGFILE, PARM_BGNYEAR,
+                                            PARM_ENDYEAR, PARM_BGNQTR,
+                                            PARM_ENDQTR, PARM_FORMS,
+                                            PARM_CIK, open_masterindex_store(PARM_MASTERINDEX_STORE),
+                                            PARM_CONCURRENCY, quarters, PARM_QUERY_STRATEGY)
+            masterindex = watermarks.new_entries(masterindex, watermark)
+            print('{0:,} new master index entries'.format(len(masterindex)))
         else:
-            append_item = Business_description_to_doc(index_entry)
-            result_list.append(append_item)
-            result_df.loc[len(result_df)] = append_item
-
-
-    # Write the resulting now into a csv file
-    print('End of Scraping, writing out now')
-    result_df.to_csv(path_or_buf = path + df_csv_result_name, encoding = 'utf-8')
-
-    with open(path + csv_result_name, "a", newline = '', encoding = 'utf-8') as f:
-        writer = csv.writer(f)
-        for status_result in result_list:
-            writer.writerow(status_result)
-    f.close()
+            quarters = [(PARM_ENDYEAR, PARM_ENDQTR)]
+            masterindex = Masterindex_query(PARM_LOGFILE, PARM_BGNYEAR,
+                                            PARM_ENDYEAR, PARM_BGNQTR,
+                                            PARM_ENDQTR, PARM_FORMS,
+                                            PARM_CIK, open_masterindex_store(PARM_MASTERINDEX_STORE),
+                                            PARM_CONCURRENCY, strategy = PARM_QUERY_STRATEGY)
+
+        # Running count of each filing id
+        file_count = {}
 
+        # Filings that still need to be scraped are collected with their position in the
+        # masterindex and downloaded concurrently afterwards
+        position = 0
+        scrape_items = []
+        scrape_positions = []
+
+        for index_entry in masterindex:
+            print('Scraping now file {0} for {1}, for the filing date {2}'.format(index_entry.form, index_entry.name, index_entry.filingdate))
+
+            fpath = filing_file_name(index_entry).replace('.txt', '')
+
+            # All filings are parsed again in reparse mode
+            existing_entries = [] if PARM_REPARSE else manifest.lookup(fpath)
+            if existing_entries:
+                print('\t file {0} for {1}, for the filing date {2} already in list => Extract Entries'.format(index_entry.form, index_entry.name, index_entry.filingdate))
+
+                for entry in existing_entries:
+                    f_text = ''
+                    bd_text = ''
+                    if entry['business_desc_file']:
+                        bd_text = LazyText(path + entry['business_desc_file'], store)
+                        if not PARM_LAZY_TEXT:
+                            bd_text = bd_text.text
+                    if entry['full_text_file']:
+                        f_text = LazyText(path + entry['full_text_file'], store)
+                        if not PARM_LAZY_TEXT:
+                            f_text = f_text.text
+                        count_filing(file_count, index_entry)
+
+                    error_message = True if entry['status'] == 'True' else entry['status']
+
+                    # Add to result list
+                    append_item = [index_entry.cik, index_entry.name, index_entry.form,
+                                        index_entry.filingdate, index_entry.path, entry['file_count'], path + entry['fname'],
+                                        f_text, bd_text, error_message]
+                    append_item = sink.write(position, append_item, scraped = False)
+                    yield position, append_item
+                    position += 1
+
+            else:
+                scrape_positions.append(position)
+                scrape_items.append((index_entry, count_filing(file_count, index_entry)))
+                position += 1
+
+        # Concurrent execution, results are written as they arrive
+        scraped_results = Async_iterate_download_to_doc(scrape_items, path,
+                                                        concurrency = PARM_CONCURRENCY,
+                                                        parse_processes = PARM_PARSE_PROCESSES,
+                                                        split_documents = PARM_SPLIT_DOCUMENTS,
+                                                        resolver = resolver,
+                                                        max_size = PARM_MAX_FILING_SIZE,
+                                                        store = store,
+                                                        raw_cache = raw_cache,
+                                                        reparse = PARM_REPARSE,
+                                                        dedup = dedup)
+        unfinished = []
+        for scrape_position, append_item in iterate_async(scraped_results):
+            raw_hash = dedup.raw_hashes.pop(scrape_position, None) if dedup is not None else None
+            append_item = sink.write(scrape_positions[scrape_position], append_item, raw_hash = raw_hash)
+            if str(append_item[9]) not in CRAWL_FINISHED_STATUSES:
+                unfinished.append(scrape_items[scrape_position][0])
+            yield scrape_positions[scrape_position], append_item
+
+        # The watermark only moves once all entries are processed
+        if watermarks is not None:
+            watermarks.update(PARM_FORMS, PARM_CIK, masterindex, unfinished, quarters[-1])
+
+        if dedup is not None:
+            sink.flush()
+            print('{0:,} duplicate filings reference the output files of an identical filing'.format(
+                len(manifest.duplicates())))
+
+    finally:
+        sink.close()
+        manifest.close()
+        if store is not None:
+            store.close()
+        if raw_cache is not None:
+            raw_cache.close()
+        if paragraph_store is not None:
+            paragraph_store.close()
+        if resolver is not None:
+            resolver.close()
+        if watermarks is not None:
+            watermarks.close()
 
     # Write the file count now into a csv file
     print('Write out file count now')
@@ -510,6 +3273,61 @@ def Download_forms(PARM_PATH, PARM_LOGFILE, PARM_BGNYEAR,
             writer.writerow([key, val])
     f.close()
 
+
+def Download_forms(PARM_PATH, PARM_LOGFILE, PARM_BGNYEAR, 
+                   PARM_ENDYEAR, PARM_BGNQTR, PARM_ENDQTR, 
+                   PARM_FORMS, PARM_CIK, PARM_CONCURRENCY=1,
+                   PARM_MASTERINDEX_STORE=None, PARM_PARSE_PROCESSES=None,
+                   PARM_SPLIT_DOCUMENTS=False, PARM_PRIMARY_DOCUMENT_CACHE=None,
+                   PARM_MAX_FILING_SIZE=None, PARM_LAZY_TEXT=False, PARM_TEXT_STORE=None,
+                   PARM_RAW_CACHE=None, PARM_REPARSE=False, PARM_DEDUPLICATE=False,
+                   PARM_PARAGRAPH_STORE=None, PARM_WATERMARK=None, PARM_QUERY_STRATEGY='auto'):
+    # Main Executions Routine
+    # PARM_CONCURRENCY sets the number of filings and master index quarters downloaded concurrently
+    # PARM_MASTERINDEX_STORE is the directory of a local master index store (None downloads every quarter)
+    # PARM_PARSE_PROCESSES sets the number of parsing processes (None = number of CPUs, 0 = no processes)
+    # PARM_SPLIT_DOCUMENTS = True parses only the documents of the filing's form type, not exhibits or graphics
+    # PARM_PRIMARY_DOCUMENT_CACHE is the sqlite file caching the primary document of each filing,
+    #   the filings are then downloaded as primary document instead of full submission (None = full submission)
+    # PARM_MAX_FILING_SIZE is the maximum filing size in bytes, larger filings are skipped as 'OVERSIZED' (None = no limit)
+    # PARM_LAZY_TEXT = True returns LazyText file references in the Full_Text and Business_Description
+    #   columns instead of the texts, which are loaded on demand with .text (see text_of)
+    # PARM_TEXT_STORE is the directory of a compressed ShardedTextStore for the output texts (None = text files)
+    # PARM_RAW_CACHE is the directory of a RawResponseCache keeping the downloaded filings (None = not kept)
+    # PARM_REPARSE = True parses the filings in PARM_RAW_CACHE again instead of downloading them,
+    #   e.g. after changing the text extraction; already scraped filings are overwritten
+    # PARM_DEDUPLICATE = True parses and stores filings with identical content or full text once, the
+    #   duplicates reference the output files of the first filing (reported in the manifest, see ScrapeManifest)
+    # PARM_PARAGRAPH_STORE is the sqlite file of a ParagraphStore keeping the full texts and business
+    #   descriptions as unique paragraphs per CIK, e.g. for year-over-year text changes (None = not kept)
+    # PARM_WATERMARK is the sqlite file of the CrawlWatermark of incremental crawls (None = crawl the window):
+    #   the first crawl of a form set and CIK universe scrapes the window, later crawls only read the master
+    #   index quarters since the last crawled filing date and scrape the entries added since then
+    # PARM_QUERY_STRATEGY = 'auto' lists the filings from the submissions JSON of the CIKs or from the master
+    #   index, whichever is estimated to download less (see plan_masterindex_query); 'submissions' or
+    #   'masterindex' force one strategy
+    # Results are written to the status files while scraping (see Iterate_forms),
+    # the returned DataFrame has the rows in the order of the master index
+    # Memory: the DataFrame holds the texts of all filings of the window, so memory grows with the window;
+    #   with PARM_LAZY_TEXT = True it only holds file references, and Iterate_forms yields the results
+    #   one by one without collecting them
+
+    results = dict(Iterate_forms(PARM_PATH, PARM_LOGFILE, PARM_BGNYEAR,
+                                 PARM_ENDYEAR, PARM_BGNQTR, PARM_ENDQTR,
+                                 PARM_FORMS, PARM_CIK, PARM_CONCURRENCY,
+                                 PARM_MASTERINDEX_STORE, PARM_PARSE_PROCESSES,
+                                 PARM_SPLIT_DOCUMENTS, PARM_PRIMARY_DOCUMENT_CACHE,
+                                 PARM_MAX_FILING_SIZE, PARM_LAZY_TEXT = PARM_LAZY_TEXT,
+                                 PARM_TEXT_STORE = PARM_TEXT_STORE,
+                                 PARM_RAW_CACHE = PARM_RAW_CACHE,
+                                 PARM_REPARSE = PARM_REPARSE,
+                                 PARM_DEDUPLICATE = PARM_DEDUPLICATE,
+                                 PARM_PARAGRAPH_STORE = PARM_PARAGRAPH_STORE,
+                                 PARM_WATERMARK = PARM_WATERMARK,
+                                 PARM_QUERY_STRATEGY = PARM_QUERY_STRATEGY))
+    print('End of Scraping')
+
+    result_df = pd.DataFrame([results[position] for position in sorted(results)], columns = RESULT_COLUMNS)
     return(result_df)
 
 
@@ -519,13 +3337,15 @@ def Download_forms(PARM_PATH, PARM_LOGFILE, PARM_BGNYEAR,
 def master_index_listing(PARM_PATH, PARM_LOGFILE,
                          PARM_BGNYEAR, PARM_ENDYEAR,
                          PARM_BGNQTR, PARM_ENDQTR,
-                         PARM_FORMS, PARM_CIK):
+                         PARM_FORMS, PARM_CIK, PARM_MASTERINDEX_STORE=None,
+                         PARM_CONCURRENCY=1, PARM_QUERY_STRATEGY='auto'):
 
     # Download Masterindex
-    masterindex = Masterindex_iteratable_download(PARM_LOGFILE, PARM_BGNYEAR,
-                                                  PARM_ENDYEAR, PARM_BGNQTR,
-                                                  PARM_ENDQTR, PARM_FORMS,
-                                                  PARM_CIK)
+    masterindex = Masterindex_query(PARM_LOGFILE, PARM_BGNYEAR,
+                                    PARM_ENDYEAR, PARM_BGNQTR,
+                                    PARM_ENDQTR, PARM_FORMS,
+                                    PARM_CIK, open_masterindex_store(PARM_MASTERINDEX_STORE),
+                                    PARM_CONCURRENCY, strategy = PARM_QUERY_STRATEGY)
 
     # Set same function parameters as in main
     path = PARM_PATH
@@ -538,11 +3358,8 @@ def master_index_listing(PARM_PATH, PARM_LOGFILE,
 
     for masterindex_item in masterindex:
         # Keep track of filings and identify duplicates
-        fid = str(masterindex_item.cik) + str(masterindex_item.filingdate) + masterindex_item.form
-        if fid in file_count:
-            file_count[fid] += 1
-        else:
-            file_count[fid] = 1
+        fid = filing_id(masterindex_item)
+        count_filing(file_count, masterindex_item)
 
         # Append index entry
         append_item = [masterindex_item.cik, masterindex_item.name,
@@ -582,6 +3399,7 @@ f_1X = ['1-A', '1-A/A', '1-K', '1-SA', '1-U', '1-Z']
 
 # EDGAR parameter
 PARM_EDGARPREFIX = 'https://www.sec.gov/Archives/'
+PARM_SUBMISSIONS_PREFIX = 'https://data.sec.gov/submissions/'
 
 
 #***********************************************
@@ -591,7 +3409,21 @@ PARM_EDGARPREFIX = 'https://www.sec.gov/Archives/'
 def Download_Execution(home_directory, PARM_PATH, 
                        PARM_BGNYEAR, PARM_ENDYEAR, 
                        PARM_FORMS, PARM_CIK, 
-                       PARM_BGNQTR=1, PARM_ENDQTR=4):
+                       PARM_BGNQTR=1, PARM_ENDQTR=4,
+                       PARM_CONCURRENCY=1,
+                       PARM_MASTERINDEX_STORE=None,
+                       PARM_PARSE_PROCESSES=None,
+                       PARM_SPLIT_DOCUMENTS=False,
+                       PARM_PRIMARY_DOCUMENT_CACHE=None,
+                       PARM_MAX_FILING_SIZE=None,
+                       PARM_LAZY_TEXT=False,
+                       PARM_TEXT_STORE=None,
+                       PARM_RAW_CACHE=None,
+                       PARM_REPARSE=False,
+                       PARM_DEDUPLICATE=False,
+                       PARM_PARAGRAPH_STORE=None,
+                       PARM_WATERMARK=None,
+                       PARM_QUERY_STRATEGY='auto'):
     '''
     METHOD: Main Routine for Execution of EDGAR Scraping
     INPUT:  home_directory = main directory where output should be created
@@ -601,7 +3433,34 @@ def Download_Execution(home_directory, PARM_PATH,
             PARM_BGNQTR = Beginning quarter of each scraping year,
             PARM_ENDQTR = End quarter of each scraping year,
             PARM_FORMS = EDGAR form type to be scraped,
-            PARM_CIK = List of CIK codes to be scraped
+            PARM_CIK = List of CIK codes to be scraped,
+            PARM_CONCURRENCY = Number of filings and master index quarters downloaded concurrently,
+            PARM_MASTERINDEX_STORE = Directory in home_directory of a local master index store, e.g.
+                                     'Masterindex Store' (None = download every quarter's master index),
+            PARM_PARSE_PROCESSES = Number of processes parsing the filings (None = number of CPUs,
+                                   0 = parse in the download threads),
+            PARM_SPLIT_DOCUMENTS = Parse only the documents of the filing's form type in the submission,
+                                   skipping exhibits, XBRL and binary documents,
+            PARM_PRIMARY_DOCUMENT_CACHE = sqlite file in home_directory caching the primary document of each
+                                          filing; the primary documents are downloaded instead of the full
+                                          submissions, None to download the full submissions,
+            PARM_MAX_FILING_SIZE = Maximum filing size in bytes, larger filings are skipped with the
+                                   status OVERSIZED (None = no limit),
+            PARM_LAZY_TEXT = Return file references (LazyText) instead of the texts in the Full_Text and
+                             Business_Description columns; the status csv files then hold the file paths,
+                             and memory no longer grows with the texts of the window,
+            PARM_TEXT_STORE = Directory in home_directory of a compressed store for the output texts,
+                              partitioned by year and quarter (None = one text file per output),
+            PARM_RAW_CACHE = Directory in home_directory of the cache of the downloaded filings (None = not kept),
+            PARM_REPARSE = Parse the cached filings in PARM_RAW_CACHE again without downloading them,
+            PARM_DEDUPLICATE = Parse and store identical filings once, duplicates reference the output files
+                               of the first filing and are listed in the manifest,
+            PARM_PARAGRAPH_STORE = sqlite file in home_directory storing the texts as unique paragraphs per CIK
+                                   (see ParagraphStore.change_frame for new and carried-over paragraphs),
+            PARM_WATERMARK = sqlite file in home_directory with the watermarks of incremental crawls; after the
+                             first crawl only the filings added since the previous crawl are scraped,
+            PARM_QUERY_STRATEGY = 'auto' reads the submissions JSON of small CIK lists and scans the master
+                                  index for large ones, 'submissions' or 'masterindex' force one of them
     OUTPUT: Result DataFrame containing fulltext and Business Descriptions,
             Folder in PARM_PATH containing scraped text files from EDGAR with the name structure
             Filingdate_FormType_ItemID; ItemID consists of CIK-FiscalYear(two digits)-Sequential Count of Submitted File
@@ -630,7 +3489,21 @@ def Download_Execution(home_directory, PARM_PATH,
     edgar_scraping_result = Download_forms(PARM_PATH, PARM_LOGFILE,
                                            PARM_BGNYEAR, PARM_ENDYEAR,
                                            PARM_BGNQTR, PARM_ENDQTR,
-                                           PARM_FORMS, PARM_CIK)
+                                           PARM_FORMS, PARM_CIK,
+                                           PARM_CONCURRENCY,
+                                           PARM_MASTERINDEX_STORE,
+                                           PARM_PARSE_PROCESSES,
+                                           PARM_SPLIT_DOCUMENTS,
+                                           PARM_PRIMARY_DOCUMENT_CACHE,
+                                           PARM_MAX_FILING_SIZE,
+                                           PARM_LAZY_TEXT,
+                                           PARM_TEXT_STORE,
+                                           PARM_RAW_CACHE,
+                                           PARM_REPARSE,
+                                           PARM_DEDUPLICATE,
+                                           PARM_PARAGRAPH_STORE,
+                                           PARM_WATERMARK,
+                                           PARM_QUERY_STRATEGY)
     
 
 
@@ -0,0 +1,194 @@
+"""
+DATE: 10/18/2026
+METHOD: Evaluation harness for name matching with the NBER name standardization routine
+
+        A labeled gold set of (raw name A, raw name B, is_match) pairs is cleaned
+        with Clean_names under several cleaning options (e.g. adjusted or
+        uspto_add_cleaning) and compared with several matching strategies.
+        For each combination of cleaning option and matching strategy the
+        harness reports precision, recall, F1 and the throughput in pairs/sec,
+        so that the accuracy/speed trade-off can be compared on the same corpus
+        in one run.
+
+USE:    Evaluate_name_matching is the main function.
+
+        Arg for Evaluate_name_matching:
+            gold_set -> DataFrame, path to a csv file, or list of (name_a, name_b, is_match) tuples
+            cleaning_options=None -> dict mapping a label to keyword arguments of Clean_names,
+                                     by default CLEANING_OPTIONS
+            strategies=None -> dict mapping a label to a function f(cleaned_a, cleaned_b) -> bool,
+                               where cleaned_a/b are the (standard_name, stemmed_name) tuples
+                               returned by Clean_names; by default MATCHING_STRATEGIES
+            repeat=1 -> number of timing repetitions, the fastest run is reported
+
+        Output:
+            DataFrame with one row per cleaning option and strategy and the columns
+            CLEANING, STRATEGY, TP, FP, FN, TN, PRECISION, RECALL, F1, PAIRS_PER_SEC
+"""
+import time
+
+import pandas as pd
+
+from nber_name_standardization import Clean_names
+
+
+# %%
+##############################################
+# Cleaning options and matching strategies   #
+##############################################
+
+# Keyword arguments passed to Clean_names for each evaluated cleaning option
+CLEANING_OPTIONS = {
+    'baseline': {'adjusted': False, 'uspto_add_cleaning': False},
+    'adjusted': {'adjusted': True, 'uspto_add_cleaning': False},
+    'uspto': {'adjusted': False, 'uspto_add_cleaning': True},
+    'adjusted_uspto': {'adjusted': True, 'uspto_add_cleaning': True},
+}
+
+
+def standard_name_match(cleaned_a, cleaned_b):
+    '''exact match of the standardized names'''
+    return cleaned_a[0] == cleaned_b[0]
+
+
+def stemmed_name_match(cleaned_a, cleaned_b):
+    '''exact match of the stemmed names (corporate identifiers removed)'''
+    return cleaned_a[1] == cleaned_b[1]
+
+
+def stemmed_nospace_match(cleaned_a, cleaned_b):
+    '''exact match of the stemmed names with the words collapsed'''
+    return cleaned_a[1].replace(' ', '') == cleaned_b[1].replace(' ', '')
+
+
+def token_jaccard_match(threshold=0.8):
+    '''returns a strategy matching the stemmed names if the Jaccard similarity
+    of their word sets is at least threshold'''
+    def match(cleaned_a, cleaned_b):
+        tokens_a = set(cleaned_a[1].split())
+        tokens_b = set(cleaned_b[1].split())
+        if not (tokens_a or tokens_b):
+            return True
+        return len(tokens_a & tokens_b) / len(tokens_a | tokens_b) >= threshold
+    return match
+
+
+MATCHING_STRATEGIES = {
+    'standard_name': standard_name_match,
+    'stemmed_name': stemmed_name_match,
+    'stemmed_nospace': stemmed_nospace_match,
+    'token_jaccard_0.8': token_jaccard_match(0.8),
+}
+
+
+# %%
+##############################################
+# Gold set and scoring                       #
+##############################################
+
+def load_gold_set(gold_set):
+    '''returns the gold set as list of (name_a, name_b, is_match) tuples'''
+    if isinstance(gold_set, str):
+        gold_set = pd.read_csv(gold_set, dtype=str, keep_default_na=False)
+    if isinstance(gold_set, pd.DataFrame):
+        gold_set = gold_set.iloc[:, :3].itertuples(index=False, name=None)
+
+    pairs = []
+    for name_a, name_b, is_match in gold_set:
+        if isinstance(is_match, str):
+            is_match = is_match.strip().lower() in ('1', 'true', 't', 'yes', 'y')
+        pairs.append((str(name_a), str(name_b), bool(is_match)))
+    return pairs
+
+
+def score_predictions(predictions, labels):
+    '''returns confusion counts, precision, recall and F1 of boolean predictions'''
+    tp = fp = fn = tn = 0
+    for predicted, actual in zip(predictions, labels):
+        if predicted and actual:
+            tp += 1
+        elif predicted:
+            fp += 1
+        elif actual:
+            fn += 1
+        else:
+            tn += 1
+
+    # Precision and recall are undefined without predicted/actual matches, report 0 as
+    # a conservative value in that case
+    precision = tp / (tp + fp) if (tp + fp) > 0 else 0.0
+    recall = tp / (tp + fn) if (tp + fn) > 0 else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if (precision + recall) > 0 else 0.0
+    return tp, fp, fn, tn, precision, recall, f1
+
+
+# %%
+##################################################
+# Main evaluation                                #
+##################################################
+
+def Evaluate_name_matching(gold_set, cleaning_options=None, strategies=None, repeat=1):
+    '''Run all gold set pairs through Clean_names for each cleaning option and score each
+    matching strategy; returns one row per cleaning option and strategy'''
+    pairs = load_gold_set(gold_set)
+    if cleaning_options is None:
+        cleaning_options = CLEANING_OPTIONS
+    if strategies is None:
+        strategies = MATCHING_STRATEGIES
+
+    labels = [is_match for _, _, is_match in pairs]
+    n_pairs = len(pairs)
+
+    col_list = ['CLEANING', 'STRATEGY', 'TP', 'FP', 'FN', 'TN',
+                'PRECISION', 'RECALL', 'F1', 'PAIRS_PER_SEC']
+    results = []
+
+    for cleaning_label, cleaning_kwargs in cleaning_options.items():
+        # Clean both names of every pair, as a pairwise matching run would do,
+        # and keep the fastest of the repeated runs
+        clean_time = None
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            cleaned = [(Clean_names(name_a, **cleaning_kwargs)[:2],
+                        Clean_names(name_b, **cleaning_kwargs)[:2])
+                       for name_a, name_b, _ in pairs]
+            elapsed = time.perf_counter() - start
+            clean_time = elapsed if clean_time is None else min(clean_time, elapsed)
+
+        for strategy_label, strategy in strategies.items():
+            match_time = None
+            for _ in range(max(1, repeat)):
+                start = time.perf_counter()
+                predictions = [bool(strategy(cleaned_a, cleaned_b)) for cleaned_a, cleaned_b in cleaned]
+                elapsed = time.perf_counter() - start
+                match_time = elapsed if match_time is None else min(match_time, elapsed)
+
+            total_time = clean_time + match_time
+            pairs_per_sec = n_pairs / total_time if total_time > 0 else float('inf')
+
+            results.append([cleaning_label, strategy_label,
+                            *score_predictions(predictions, labels), pairs_per_sec])
+
+    return pd.DataFrame(results, columns=col_list)
+
+
+########################################################################
+# Main Executions
+########################################################################
+if __name__ == '__main__':
+
+    # Small sample gold set, replace with a labeled csv file with the columns
+    # name_a, name_b, is_match for actual evaluations
+    sample_gold_set = [
+        ('Apple Computer Inc.', 'APPLE INC', True),
+        ('Apple Inc', 'Apple Incorporated', True),
+        ('International Business Machines Corp', 'INTL BUSINESS MACHINES CORPORATION', True),
+        ('Johnson & Johnson', 'JOHNSON AND JOHNSON', True),
+        ('Alphabet Inc-CL A', 'Alphabet Inc', True),
+        ('General Electric Co', 'General Motors Co', False),
+        ('Pfizer Inc', 'PFIZER PHARMACTLS INC', False),
+        ('Merck & Co Inc', 'Merck KGaA', False),
+    ]
+
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(Evaluate_name_matching(sample_gold_set, repeat=3))
@@ -0,0 +1,87 @@
+import functools
+import http.server
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+# The scraping scripts are modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import EDGAR_Text_Scraping as scraping
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def slow_content(size):
+    return bytes(i % 251 for i in range(size))
+
+
+class FixtureHandler(http.server.SimpleHTTPRequestHandler):
+    # Serves the fixtures like the EDGAR archive, plus
+    #   /status/<code> = an empty response with that status
+    #   /slow/<bytes>/<chunks>/<seconds> = close-delimited content without Content-Length (see slow_content),
+    #                                      sent in chunks over the given time; Range requests are resumed
+    # and the status of server.failures[path] instead of the paths listed there
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.hits.append((self.path, dict(self.headers)))
+        parts = self.path.strip('/').split('/')
+        if self.path in self.server.failures or parts[0] == 'status':
+            self.send_response(self.server.failures.get(self.path) or int(parts[1]))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif parts[0] == 'slow':
+            size, chunks, seconds = int(parts[1]), int(parts[2]), float(parts[3])
+            content = slow_content(size)
+            start = 0
+            if self.headers.get('Range', '').startswith('bytes='):
+                start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, size - 1, size))
+            else:
+                self.send_response(200)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            chunk_size = size // chunks
+            try:
+                for offset in range(start, size, chunk_size):
+                    self.wfile.write(content[offset:offset + chunk_size])
+                    self.wfile.flush()
+                    time.sleep(seconds / chunks)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client aborted the download
+                pass
+            self.close_connection = True
+        else:
+            super().do_GET()
+
+
+@pytest.fixture
+def server():
+    # Local HTTP server of the fixtures, .hits lists the (path, headers) of the requests
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(FixtureHandler, directory=FIXTURES))
+    httpd.hits = []
+    httpd.failures = {}
+    httpd.url = 'http://127.0.0.1:{0}/'.format(httpd.server_port)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def transport(tmp_path, monkeypatch):
+    # Transport without rate limit and backoff waits, also used by the module functions
+    rate_limiter = scraping.SECRateLimiter(state_file=str(tmp_path / 'rate_limiter.json'), max_rate=1000)
+    transport = scraping.EDGARTransport(rate_limiter=rate_limiter, backoff_factor=0)
+    monkeypatch.setattr(scraping, 'RATE_LIMITER', rate_limiter)
+    monkeypatch.setattr(scraping, 'TRANSPORT', transport)
+    return transport
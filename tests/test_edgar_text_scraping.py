@@ -0,0 +1,472 @@
+import asyncio
+import datetime
+import os
+import random
+import re
+import time
+import unicodedata
+
+import pytest
+import requests
+
+import EDGAR_Text_Scraping as scraping
+from conftest import FIXTURES, slow_content
+
+
+#
+# Filing document
+
+TEXT_TREE_CASES = [
+    # End tags without an open element end the text node
+    '<html><body><p>Hello</font>World</p></body></html>',
+    '<html><body><p>Our products</b>include phones</p></body></html>',
+    # Nested forms are removed with their text
+    '<html><body><p>Before</p><form>Field<form>Inner</form>Still form</form><p>After</p></body></html>',
+    # An end tag closes the elements opened after its own
+    '<html><body><div><form>Hidden</div>Shown</body></html>',
+    # Only the first body, not the following documents of a full submission
+    '<html><body><p>Filing</p></body></html><TEXT><html><body><p>Exhibit</p></body></html>',
+    # Whitespace, entities, void elements, comments and CDATA
+    '<html><body>\n  <p>A&amp;B&nbsp;C&#150;</p><br></br>x<!-- note -->y<pre>  </pre><![CDATA[cd]]></body></html>',
+    # Skipped tags around the body are kept like BeautifulSoup keeps them
+    '<html><form><body><p>Inside</p></body></form></html>',
+]
+
+
+@pytest.mark.parametrize('content', TEXT_TREE_CASES)
+def test_text_tree_matches_beautifulsoup(content):
+    assert scraping.Extract_text_tree_stream(content) == scraping.Extract_text_tree_bs4(content)
+    assert scraping.Extract_text_tree_stream(content.encode()) == scraping.Extract_text_tree_bs4(content.encode())
+
+
+def test_text_tree_splits_at_stray_end_tags():
+    assert scraping.Extract_text_tree('<html><body><p>Hello</font>World</p></body></html>'.encode()) == ['Hello', 'World']
+    assert scraping.Extract_text_tree(b'<html><body><p>Our products</b>include phones</p></body></html>') == \
+        ['Our products', 'include phones']
+
+
+def test_text_tree_drops_nested_forms():
+    content = b'<html><body><p>Before</p><form>Field<form>Inner</form>Still form</form><p>After</p></body></html>'
+    assert scraping.Extract_text_tree(content) == ['Before', 'After']
+
+
+def test_text_tree_chunks():
+    content = TEXT_TREE_CASES[5] * 3
+    assert scraping.Extract_text_tree_stream(content, chunk_size=5) == scraping.Extract_text_tree_stream(content)
+
+
+#
+# Text normalization and item index
+#   reference_text_normlization and reference_business_desc are the one-pattern-per-pass
+#   versions of Text_Normlization and Extract_Business_Desc before the passes were merged
+
+def reference_text_normlization(text):
+    text = unicodedata.normalize('NFKC', text)
+
+    text = re.sub(r'\n|\r|\t', ' ', text)
+    text = re.sub(r'\s+', ' ', text)
+    text = text.strip()
+
+    text = re.sub(re.compile("Items", re.IGNORECASE), "Item", text)
+    text = re.sub(re.compile("PART I", re.IGNORECASE), "", text)
+    text = re.sub(re.compile("ITEM III", re.IGNORECASE), "Item 3", text)
+    text = re.sub(re.compile("ITEM II", re.IGNORECASE), "Item 2", text)
+    text = re.sub(re.compile("Item I|Item l", re.IGNORECASE), "Item 1", text)
+
+    text = re.sub(re.compile(":|\\*", re.IGNORECASE), "", text)
+    text = re.sub('-', ' ', text)
+
+    text = text.replace("ONE", "1")
+    text = re.sub(re.compile("ONE", re.IGNORECASE), "1", text)
+    text = re.sub(re.compile("TWO", re.IGNORECASE), "2", text)
+    text = re.sub(re.compile("THREE", re.IGNORECASE), "3", text)
+
+    text = re.sub(r'1\s{0,}\.', '1', text)
+    text = re.sub(r'2\s{0,}\.', '2', text)
+    text = re.sub(r'3\s{0,}\.', '3', text)
+    return text
+
+
+def reference_business_desc(text_tree):
+    text = [reference_text_normlization(node) for node in text_tree]
+
+    empty_line = re.compile(r"^\s*$", re.IGNORECASE)
+    item_number = re.compile(r"^ITEM\s{0,}\d{0,}\s{0,}$|^ITEM\s{0,}1 AND 2\s{0,}$", re.IGNORECASE)
+    text = [line for line in text if not empty_line.match(line)]
+
+    item_numbers = [m for m in range(0, len(text) - 1) if item_number.match(text[m])]
+    for m in item_numbers:
+        text[m+1] = text[m] + ' ' + text[m+1]
+
+    startline = re.compile(r"^ITEM\s{0,}1\s{0,}\W{0,}\s{0,}BUSINESS\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}1\s{0,}\W{0,}\s{0,}DESCRIPTION OF BUSINESS\s{0,}\.{0,1}\s{0,}$", re.IGNORECASE)
+    endline = re.compile(r"^ITEM\s{0,}2\s{0,}\W{0,}\s{0,}PROPERTIES\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}2\s{0,}\W{0,}\s{0,}DESCRIPTION OF PROPERTY\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}2\s{0,}\W{0,}\s{0,}REAL ESTATE\s{0,}\.{0,1}\s{0,}$", re.IGNORECASE)
+    startline_positions = [m for m in range(0, len(text)) if startline.match(text[m])]
+    endline_positions = [m for m in range(0, len(text)) if endline.match(text[m])]
+
+    if len(startline_positions) == 0:
+        startline = re.compile(r"^ITEM\s{0,}1 AND 2\s{0,}\W{0,}\s{1,}BUSINESS AND PROPERTIES\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}1 AND 2\s{0,}\W{0,}\s{1,}BUSINESS AND DESCRIPTION OF PROPERTY\s{0,}\.{0,1}\s{0,}$", re.IGNORECASE)
+        endline = re.compile(r"^ITEM\s{0,}3s{0,}\W{0,}\s{1,}LEGAL PROCEEDINGS\s{0,}\.{0,1}\s{0,}$|^ITEM\s{0,}3s{0,}\W{0,}\s{1,}LEGAL MATTERS\s{0,}\.{0,1}\s{0,}$", re.IGNORECASE)
+        startline_positions += [m for m in range(0, len(text)) if startline.match(text[m])]
+        endline_positions += [m for m in range(0, len(text)) if endline.match(text[m])]
+
+    if min(len(startline_positions), len(endline_positions)) > 0:
+        passages = []
+        if len(startline_positions) == len(endline_positions):
+            for i in range(0, len(startline_positions)):
+                passages.append(' '.join(text[startline_positions[i]:endline_positions[i]]))
+        else:
+            passages.append(' '.join(text[startline_positions[-1]:endline_positions[-1]]))
+        passages = [re.sub(r'\s{2,}', ' ', passage) for passage in passages]
+        return max(passages, key = len)
+    else:
+        return 'PARSINGERROR'
+
+
+NORMALIZATION_CASES = [
+    # A TWO followed by NE loses its O to the ONE pass
+    'TWONE twone TwoNe NETWORK ONE TWO THREE',
+    'ONETWOTHREE Someone, anyone; two. three .',
+    # Item headers
+    'PART I Item I: Business', 'Items 1 and 2', 'ITEM III - Legal Proceedings', 'item ii.  Properties',
+    'Item l. Business', 'PART II\tITEM 7A * Market Risk',
+    # No 'ITEM' or 'PART I', the header passes are skipped
+    'Net sales rose 1 . 2 percent', 'Part 1 of 3', 'It em I', '',
+    # Unicode and whitespace
+    'ＩＴＥＭ 1․ Business', '  \n\r\t  ', 'a  b\n\nc ',
+    'é ﬁne ①',
+]
+
+BUSINESS_TREES = [
+    ['PART I', 'Item 1.', 'Business', 'We make computers.', 'Item 1A.', 'Risk Factors', 'Risks.',
+     'Item 2.', 'Properties', 'Offices.'],
+    # Table of contents and body, the longest passage is used
+    ['Item 1. Business', 'Item 2. Properties', 'Item 1. Business', 'We make computers.', 'More text.',
+     'Item 2. Properties', 'Offices.'],
+    # More start than end lines, the last mentioning is used
+    ['Item 1 Business', 'Item 1 Business', 'Body text.', 'Item 2 Properties'],
+    # Fallback patterns
+    ['Item 1 and 2', 'Business and Properties', 'Body text.', 'Item 3 Legal Proceedings', 'Suits.'],
+    ['ITEM I - DESCRIPTION OF BUSINESS', '', '  ', 'Body   text.', 'ITEM II - DESCRIPTION OF PROPERTY'],
+    ['No headers here.'],
+]
+
+
+@pytest.mark.parametrize('text', NORMALIZATION_CASES)
+def test_normalization_matches_reference(text):
+    assert scraping.Text_Normlization(text) == reference_text_normlization(text)
+
+
+def test_normalization_batch_matches_reference():
+    assert scraping.Text_Normlization_batch(NORMALIZATION_CASES) == \
+        [reference_text_normlization(text) for text in NORMALIZATION_CASES]
+    # The NUL separator in a text node falls back to normalizing node by node
+    texts = ['Item 1\x00Business', 'TWO\x00NE', ' \x00 ']
+    assert scraping.Text_Normlization_batch(texts) == [reference_text_normlization(text) for text in texts]
+
+
+def test_normalization_batch_matches_reference_randomized():
+    rng = random.Random(34)
+    alphabet = ['ITEM', 'item', 'Items', 'PART I', 'I', 'II', 'III', 'l', 'ONE', 'one', 'TWO', 'NE', 'three',
+                '1', '2', '3', '.', ':', '*', '-', ' ', '  ', '\n', '\t', ' ', 'ﬁ', 'é', 'x']
+    for _ in range(200):
+        texts = [''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 12))) for _ in range(rng.randint(1, 8))]
+        assert scraping.Text_Normlization_batch(texts) == [reference_text_normlization(text) for text in texts]
+
+
+@pytest.mark.parametrize('text_tree', BUSINESS_TREES)
+def test_business_description_matches_reference(text_tree):
+    assert scraping.Extract_Business_Desc(text_tree) == reference_business_desc(text_tree)
+    normalized = scraping.Text_Normlization_batch(text_tree)
+    assert scraping.ItemIndex(normalized).business_description() == reference_business_desc(text_tree)
+
+
+def test_item_index_offsets_slice_full_text(tmp_path):
+    content = ('<html><body><p>PART I</p><p>Item 1.</p><p>Business</p><p>We make computers.</p>'
+               '<p>Item 1A.</p><p>Risk Factors</p><p>Supply may fail.</p>'
+               '<p>Item 2.</p><p>Properties</p><p>Offices.</p>'
+               '<p>PART II</p><p>Item 7. Management\'s Discussion</p><p>Sales grew.</p>'
+               '<p>Item 7A. Market Risk</p><p>Rates.</p></body></html>').encode()
+    item = record(20221028, 'edgar/data/320193/0000320193-22-000108.txt')
+    result = scraping.Parse_filing_to_doc(item, 1, content, path_dir=str(tmp_path) + '/')
+    fname_ft = result[6].replace('.txt', '_FullText_1.txt')
+
+    assert scraping.Load_item_section(fname_ft, '1') == 'Item 1 Business We make computers.'
+    assert scraping.Load_item_section(fname_ft, '1A') == 'Item 1A. Risk Factors Supply may fail.'
+    assert scraping.Load_item_section(fname_ft, '7') == "Item 7. Management's Discussion Sales grew."
+    assert scraping.Load_item_section(fname_ft, '7A') == 'Item 7A. Market Risk Rates.'
+    assert scraping.Load_item_section(fname_ft, '10Q_2') is None
+    assert result[8] == reference_business_desc(scraping.Extract_text_tree(content))
+
+
+#
+# Transport
+
+def test_download_without_content_length_uses_measured_throughput(server, transport, tmp_path):
+    # 40 kB over 1.5 seconds is faster than 10 kB/s, although it takes longer than the read timeout
+    path = str(tmp_path / 'slow.txt')
+    status, response = transport.download(server.url + 'slow/40000/20/1.5', path, timeout=1,
+                                          min_bytes_per_second=10000, grace_period=0.5, verbose=False)
+    assert status == 'OK'
+    assert os.path.getsize(path) == 40000
+
+
+def test_download_resumes_slow_transfer(server, transport, tmp_path):
+    # 40 kB at 10 kB/s is aborted every grace period, each attempt makes progress and uses up no try
+    path = str(tmp_path / 'slow.txt')
+    status, response = transport.download(server.url + 'slow/40000/40/4', path, timeout=1, number_of_tries=1,
+                                          min_bytes_per_second=20000, grace_period=0.3, verbose=False)
+    assert status == 'OK'
+    assert len(server.hits) > 1
+    assert server.hits[-1][1]['Range'].startswith('bytes=')
+    with open(path, 'rb') as f:
+        assert f.read() == slow_content(40000)
+
+
+def test_download_requests_identity_encoding(server, transport, tmp_path):
+    path = str(tmp_path / 'filing.htm')
+    status, response = transport.download(server.url + 'filings/10k.htm', path, verbose=False)
+    assert status == 'OK'
+    assert server.hits[-1][1]['Accept-Encoding'] == 'identity'
+    with open(path, 'rb') as f:
+        assert f.read() == open(os.path.join(FIXTURES, 'filings', '10k.htm'), 'rb').read()
+
+
+def test_download_retries_once_per_try(server, transport, tmp_path):
+    status, response = transport.download(server.url + 'status/500', str(tmp_path / 'error'),
+                                          number_of_tries=3, verbose=False)
+    assert status is None and response.status_code == 500
+    assert len(server.hits) == 3
+
+
+#
+# Daily index
+
+def test_daily_index_fetch_statuses(server, transport):
+    source = scraping.DailyIndexSource(server.url + 'Archives/edgar/daily-index/')
+    entries = source.entries(datetime.date(2021, 1, 4), ['10-K'], [320193])
+    assert [(entry.cik, entry.form) for entry in entries] == [(320193, '10-K')]
+    # Not posted
+    assert source.entries(datetime.date(2021, 1, 5)) is None
+    # Failures are not taken for a missing daily index
+    server.failures['/Archives/edgar/daily-index/2021/QTR1/master.20210104.idx'] = 500
+    with pytest.raises(requests.HTTPError):
+        source.fetch(datetime.date(2021, 1, 4))
+
+
+def test_poll_keeps_failed_days_pending(tmp_path, monkeypatch):
+    # A day whose daily index fails is polled again, even after the grace days,
+    # and its filings are scraped although the next day was read first
+    failing_day = datetime.date.today() - datetime.timedelta(days=10)
+    next_day = failing_day + datetime.timedelta(days=1)
+    filings = {day: record(int(day.strftime('%Y%m%d')), 'edgar/data/320193/{0}.txt'.format(day.isoformat()))
+               for day in (failing_day, next_day)}
+    calls, scraped = [], []
+
+    class FlakySource:
+        def __init__(self, root=None, transport=None):
+            pass
+
+        def entries(self, date, forms=None, ciks=None):
+            calls.append(date)
+            if date == failing_day and calls.count(date) == 1:
+                raise requests.HTTPError('503 Server Error')
+            return [filings[date]] if date in filings else None
+
+    def iterate_forms(*args, PARM_MASTERINDEX=None, **kwargs):
+        for position, entry in enumerate(PARM_MASTERINDEX):
+            scraped.append(entry.path)
+            yield position, [entry.cik, entry.name, entry.form, entry.filingdate, entry.path, 1, '', '', '', True]
+
+    monkeypatch.setattr(scraping, 'DailyIndexSource', FlakySource)
+    monkeypatch.setattr(scraping, 'Iterate_forms', iterate_forms)
+    monkeypatch.chdir(tmp_path)
+    watermark_file = str(tmp_path / 'watermark.sqlite')
+    list(scraping.Poll_daily_index('out', 'log', ['10-K'], [320193], PARM_WATERMARK=watermark_file,
+                                   PARM_START_DATE=failing_day, PARM_POLL_INTERVAL=0, PARM_MAX_POLLS=2))
+    assert calls.count(failing_day) == 2
+    assert calls.count(next_day) == 1
+    assert sorted(scraped) == sorted(entry.path for entry in filings.values())
+
+    watermarks = scraping.CrawlWatermark(watermark_file)
+    watermark = watermarks.get(['10-K'], [320193])
+    assert watermark['last_filingdate'] == filings[next_day].filingdate
+    assert watermark['retry'] == []
+    watermarks.close()
+
+
+#
+# Incremental crawls
+
+def record(day, path, cik=320193, form='10-K'):
+    return scraping.MasterIndexRecord.from_values(cik, 'APPLE INC', form, day, path)
+
+
+def test_watermark_quarters_ignore_retries(tmp_path):
+    watermarks = scraping.CrawlWatermark(str(tmp_path / 'watermark.sqlite'))
+    old = record(20190110, 'edgar/data/320193/old.txt')
+    watermarks.update(['10-K'], [320193], [old, record(20220105, 'edgar/data/320193/new.txt')], [old], (2022, 1))
+    watermark = watermarks.get(['10-K'], [320193])
+    # The entry to retry is listed without reading the master index of its quarter again
+    assert watermarks.quarters(watermark, today=datetime.date(2022, 5, 1)) == [(2022, 1), (2022, 2)]
+    assert [entry.path for entry in watermarks.new_entries([], watermark)] == [old.path]
+    watermarks.close()
+
+
+def test_watermark_retries_are_capped(tmp_path):
+    watermarks = scraping.CrawlWatermark(str(tmp_path / 'watermark.sqlite'), max_attempts=3)
+    failing = record(20220105, 'edgar/data/320193/failing.txt')
+    retried = []
+    for crawl in range(4):
+        watermark = watermarks.get(['10-K'], [320193])
+        entries = [failing] if watermark is None else watermarks.new_entries([], watermark)
+        retried.append(len(entries))
+        watermarks.update(['10-K'], [320193], entries, entries, (2022, 1))
+    assert retried == [1, 1, 1, 0]
+    watermarks.close()
+
+
+def test_oversized_filings_finish_crawls():
+    assert 'OVERSIZED' in scraping.CRAWL_FINISHED_STATUSES
+    assert 'DOWNLOADINGERROR' not in scraping.CRAWL_FINISHED_STATUSES
+
+
+#
+# Paragraph store
+
+def test_paragraph_store_replaces_changed_texts(tmp_path):
+    paragraphs = scraping.ParagraphStore(str(tmp_path / 'paragraphs.sqlite'))
+    result = [320193, 'APPLE INC', '10-K', 20221028, 'edgar/data/320193/0000320193-22-000108.txt',
+              1, 'out/20221028_10-K_edgar_data_320193_0000320193-22-000108.txt',
+              'Item 1. Business\n\nWe make phones.', 'We make phones.', 'True']
+    paragraphs.add_result(result)
+    # A reparse with a better parser changes the texts of the same output files
+    result[7], result[8] = 'Item 1. Business\n\nWe make phones and computers.', 'We make phones and computers.'
+    paragraphs.add_result(result)
+    name = '20221028_10-K_edgar_data_320193_0000320193-22-000108_FullText_1.txt'
+    assert paragraphs.get(name) == 'Item 1. Business\n\nWe make phones and computers.'
+    assert paragraphs.stored_hash(name) == scraping.text_hash(result[7])
+    paragraphs.close()
+
+
+#
+# Concurrent download and parsing pipeline
+
+def test_duplicates_do_not_block_a_single_parser(tmp_path, monkeypatch):
+    # Five different contents among many filings, downloaded in varying order while the parse queue is full
+    def fetch_filing(masterindex_item, resolver=None, max_size=None, raw_cache=None):
+        time.sleep(random.random() * 0.003)
+        number = int(os.path.basename(masterindex_item.path).split('.')[0])
+        path = str(tmp_path / 'download_{0}'.format(number))
+        with open(path, 'wb') as f:
+            f.write('<html><body><p>Item 1. Business</p><p>Filing {0}</p></body></html>'.format(number % 5).encode())
+        return scraping.FilingDownload(path, 'OK')
+
+    monkeypatch.setattr(scraping, 'fetch_filing', fetch_filing)
+    scrape_items = [(record(20220105, 'edgar/data/320193/{0}.txt'.format(i)), 1) for i in range(500)]
+    path_dir = str(tmp_path) + '//'
+
+    async def scrape():
+        return [item async for item in scraping.Async_iterate_download_to_doc(
+            scrape_items, path_dir, concurrency=8, parse_processes=0, queue_size=1,
+            dedup=scraping.ContentDedup())]
+
+    results = asyncio.run(asyncio.wait_for(scrape(), 30))
+    assert sorted(position for position, _ in results) == list(range(500))
+    # Each content is parsed once, the other filings reuse its texts
+    assert len(list(tmp_path.glob('*_FullText_1.txt'))) == 5
+    assert all(result[7].endswith('Filing {0}'.format(position % 5)) for position, result in results)
+
+
+#
+# Query planner
+
+def test_query_strategies_list_the_same_records(server, transport, tmp_path, monkeypatch):
+    monkeypatch.setattr(scraping, 'PARM_SUBMISSIONS_PREFIX', server.url + 'submissions/')
+    listings, requested = {}, {}
+    for strategy in scraping.QUERY_STRATEGIES:
+        store = scraping.MasterIndexStore(str(tmp_path / strategy), root_path=server.url + 'Archives/edgar/full-index/')
+        hits = len(server.hits)
+        records = scraping.Masterindex_query(str(tmp_path / 'log.txt'), 2021, 2022, 4, 4, ['10-K', '10-Q'],
+                                             [320193], store, strategy=strategy)
+        listings[strategy] = [(r.cik, r.name, r.form, r.filingdate, r.path) for r in records]
+        requested[strategy] = sorted(set(path.split('/')[1] for path, _ in server.hits[hits:]))
+
+    assert listings['submissions'] == listings['masterindex'] == listings['auto']
+    assert listings['auto'] == [
+        (320193, 'Apple Inc.', '10-K', 20211029, 'edgar/data/320193/0000320193-21-000105.txt'),
+        (320193, 'Apple Inc.', '10-K', 20221028, 'edgar/data/320193/0000320193-22-000108.txt'),
+        (320193, 'Apple Inc.', '10-Q', 20221104, 'edgar/data/320193/0000320193-22-000110.txt')]
+    # One CIK is cheaper from its submissions JSON than from two master indexes
+    assert requested == {'submissions': ['submissions'], 'masterindex': ['Archives'], 'auto': ['submissions']}
+
+
+def test_query_planner_choice():
+    quarters = [(2022, 1), (2022, 2), (2022, 3), (2022, 4)]
+    today = datetime.date(2023, 1, 15)
+    assert scraping.plan_masterindex_query(quarters, [320193], today=today)[0] == 'submissions'
+    assert scraping.plan_masterindex_query(quarters, range(1, 10001), today=today)[0] == 'masterindex'
+
+
+#
+# Primary documents
+
+def test_primary_document_resolver(server, transport, tmp_path):
+    archive = server.url + 'Archives/'
+    cache_file = str(tmp_path / 'primary_documents.sqlite')
+    filings = {
+        # Inline XBRL viewer link of a 10-K
+        'edgar/data/320193/0000320193-22-000108.txt':
+            archive + 'edgar/data/320193/000032019322000108/aapl-20220924.htm',
+        # 10-K document
+        'edgar/data/320193/0000320193-18-000145.txt':
+            archive + 'edgar/data/320193/000032019318000145/a10-k20189292018.htm',
+        # Old text filing without a document of its form type
+        'edgar/data/320193/0000912057-94-000263.txt':
+            archive + 'edgar/data/320193/0000912057-94-000263.txt',
+        # No index page
+        'edgar/data/320193/0000320193-99-000001.txt':
+            archive + 'edgar/data/320193/0000320193-99-000001.txt',
+    }
+    resolver = scraping.PrimaryDocumentResolver(cache_file, base_url=archive)
+    assert {path: resolver.resolve(record(20221028, path)) for path in filings} == filings
+    assert len(server.hits) == len(filings)
+    resolver.close()
+
+    # The cache answers without requests, also after a restart
+    resolver = scraping.PrimaryDocumentResolver(cache_file, base_url=archive)
+    assert {path: resolver.resolve(record(20221028, path)) for path in filings} == filings
+    assert len(server.hits) == len(filings)
+    assert resolver.cached_document('edgar/data/320193/0000320193-22-000108.txt') == \
+        'edgar/data/320193/000032019322000108/aapl-20220924.htm'
+    resolver.close()
+
+
+def test_iterate_forms_closes_the_resolver(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    resolver = scraping.PrimaryDocumentResolver(str(tmp_path / 'primary_documents.sqlite'))
+    list(scraping.Iterate_forms('out', 'log.txt', 2022, 2022, 4, 4, ['10-K'], [320193],
+                                PARM_PRIMARY_DOCUMENT_CACHE=resolver, PARM_MASTERINDEX=[]))
+    with pytest.raises(scraping.sqlite3.ProgrammingError):
+        resolver.cached_document('edgar/data/320193/0000320193-22-000108.txt')
+
+
+def test_parse_processes_do_not_inherit_held_locks(tmp_path, monkeypatch):
+    # The main thread holds the store lock (e.g. in a manifest lookup) while the parse pool starts its worker
+    def fetch_filing(masterindex_item, resolver=None, max_size=None, raw_cache=None):
+        path = str(tmp_path / 'download')
+        with open(path, 'wb') as f:
+            f.write(b'<html><body><p>Item 1. Business</p><p>We make computers.</p></body></html>')
+        return scraping.FilingDownload(path, 'OK')
+
+    monkeypatch.setattr(scraping, 'fetch_filing', fetch_filing)
+    store = scraping.ShardedTextStore(str(tmp_path / 'store'))
+    scrape_items = [(record(20220105, 'edgar/data/320193/0000320193-22-000001.txt'), 1)]
+
+    async def scrape():
+        return [item async for item in scraping.Async_iterate_download_to_doc(
+            scrape_items, str(tmp_path) + '//', parse_processes=1, store=store)]
+
+    with store._lock:
+        results = asyncio.run(asyncio.wait_for(scrape(), 120))
+    assert str(results[0][1][9]) in scraping.FINISHED_STATUSES
+    assert 'We make computers.' in store.get('20220105_10-K_edgar_data_320193_0000320193-22-000001_FullText_1.txt')